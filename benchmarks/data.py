@@ -0,0 +1,77 @@
+'''
+Generates realistic Sage getmenuitems payloads for benchmarks: every day of the week,
+a realistic spread of meals and stations, recipes that come back week after week, and
+allergens. The same seed always gives the same menu
+'''
+import random
+
+# Allergen ids like the ones Sage sends, 999999 is Sage's "made without gluten" marker
+ALLERGEN_IDS = (41, 42, 43, 44, 45, 46, 161, 162, 163, 164, 611, 612, 613, 999999)
+
+# The stations each meal usually has, see STATION_TITLES
+MEAL_STATIONS = {0: (0, 1, 3, 8),
+                 1: (0, 1, 2, 3, 4, 5, 6, 7, 9),
+                 2: (0, 1, 3, 5, 6, 9, 15)}
+
+# Weekends only have brunch (served as lunch) and dinner
+WEEKEND_MEALS = (1, 2)
+
+# Words recipe names are made from
+ADJECTIVES = ('Roasted', 'Grilled', 'Baked', 'Spicy', 'Crispy', 'Braised', 'Herbed', 'Smoked',
+              'Lemon', 'Garlic', 'Honey', 'Teriyaki', 'Cajun', 'Creamy', 'Seasonal')
+MAINS = ('Chicken', 'Salmon', 'Tofu', 'Beef', 'Turkey', 'Pork', 'Chickpea', 'Lentil', 'Shrimp',
+         'Vegetable', 'Mushroom', 'Black Bean', 'Cod', 'Egg', 'Quinoa')
+DISHES = ('Tikka Masala', 'Tacos', 'Stir Fry', 'Curry', 'Soup', 'Chowder', 'Wrap', 'Salad',
+          'Flatbread', 'Pasta', 'Burrito Bowl', 'Sandwich', 'Casserole', 'Chili', 'Frittata')
+
+
+class MenuGenerator:
+    '''
+    Generates the getmenuitems payload of any week of a menu
+
+    menu_id: the Sage menu id the items belong to
+    recipes: how many different recipes the menu rotates through
+    seed: the random seed, so every run benchmarks the same data
+    '''
+    def __init__(self, menu_id: int = 90945, recipes: int = 1500, seed: int = 0):
+        self.menu_id = menu_id
+        self.seed = seed
+
+        rnd = random.Random(seed)
+        # Each recipe keeps its name and allergens everywhere it's served, like in Sage
+        self.recipes = []
+        for recipe_id in rnd.sample(range(100000, 200000), recipes):
+            name = f'{rnd.choice(ADJECTIVES)} {rnd.choice(MAINS)} {rnd.choice(DISHES)}'
+            if rnd.random() < 0.1:
+                # Sage sends some names html escaped
+                name += ' &amp; Rice'
+            allergens = sorted(rnd.sample(ALLERGEN_IDS, rnd.randint(0, 4)))
+            self.recipes.append((recipe_id, name, allergens))
+
+    def week(self, week: int) -> list:
+        '''
+        Returns a new getmenuitems payload for a week. It's new every time, as formatting
+        a payload for storage changes it
+        '''
+        rnd = random.Random(self.seed * 100003 + week)
+        items = []
+
+        for day in range(7):
+            meals = WEEKEND_MEALS if day in (0, 6) else tuple(MEAL_STATIONS)
+            for meal in meals:
+                for station in MEAL_STATIONS[meal]:
+                    for card in range(rnd.randint(1, 5)):
+                        recipe_id, name, allergens = rnd.choice(self.recipes)
+                        items.append({
+                            # Ids are unique across every week of every menu
+                            'id': str(self.menu_id * 10 ** 8 + week * 10 ** 4 + len(items)),
+                            'menuId': str(self.menu_id), 'recipeId': str(recipe_id),
+                            'day': str(day), 'week': str(week), 'meal': str(meal),
+                            'station': str(station), 'card': str(card), 'name': name,
+                            'desc': '', 'price': '0.00', 'dot': rnd.randint(1, 7),
+                            'featured': rnd.random() < 0.05, 'rating': -1,
+                            'popular': rnd.random() < 0.2,
+                            'allergens': [{'id': str(allergen)} for allergen in allergens],
+                            'compositeItem': False})
+
+        return items
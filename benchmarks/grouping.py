@@ -0,0 +1,112 @@
+'''
+Compares Fetcher.process_response against the old sort and regroup implementation
+on a synthetic multi-week dataset
+
+Run from the project root with: python -m benchmarks.grouping
+'''
+import random
+import timeit
+import tracemalloc
+from collections import namedtuple
+from datetime import date, timedelta
+from itertools import groupby
+from menu.fetch import Fetcher
+
+# Mirrors the columns Fetcher selects for /fetch
+Row = namedtuple('Row', ['id', 'menu_id', 'recipe_id', 'day', 'week', 'meal', 'card', 'dot',
+                         'station', 'name', 'allergens', 'date', 'misc'])
+
+
+def generate_rows(weeks: int, seed: int = 0) -> list:
+    '''
+    Generates menu item rows for a number of weeks, 5 days a week, 3 meals a day,
+    with 6 stations of 4 items each per meal
+
+    returns: rows in the order process_response expects them (date, meal, station, id)
+    '''
+    rnd = random.Random(seed)
+    start = date(2019, 8, 18)
+    rows = []
+    item_id = 0
+    for week in range(weeks):
+        for day in range(1, 6):
+            for meal in range(3):
+                for station in (0, 1, 2, 3, 5, 15):
+                    for card in range(4):
+                        item_id += 1
+                        rows.append(Row(item_id, 90945, rnd.randint(1, 2000), day, week, meal,
+                                        card, rnd.randint(1, 7), station,
+                                        f'Recipe {rnd.randint(1, 2000)}', '[{"id": "41"}]',
+                                        start + timedelta(weeks=week, days=day), '{}'))
+    return rows
+
+
+def legacy_group_by_key(data: list, key: str) -> dict:
+    '''
+    The old helper legacy_process_response grouped with, kept here as the baseline.
+    Takes a list of dicts, groups the dicts into 'buckets' determined by a key in the dict,
+    then returns the bucket.
+
+    data: list, A list of dicts
+    key: str, A key that every dict in data must have, sorts by this key
+    '''
+    # Sort the data for the groupby function
+    sorted_data = sorted(data, key=lambda k: k[key])
+
+    grouped_data = {}
+    # iterate through the groupby iterator, and add to a dictionary
+    for k, g in groupby(sorted_data, key=lambda k: k[key]):
+        grouped_data[str(k)] = list(g)
+
+    return grouped_data
+
+
+def legacy_process_response(response) -> dict:
+    # The implementation process_response replaced, kept here to compare against
+    response = sorted([i._asdict() for i in response], key=lambda k: k['date'])
+
+    grouped_response = {}
+    for k, g in groupby(response, key=lambda k: k['date']):
+        grouped_response[k.strftime('%Y-%m-%d')] = list(g)
+
+    for key, value in grouped_response.items():
+        grouped_value = legacy_group_by_key(value, 'meal')
+
+        for sub_key, sub_value in grouped_value.items():
+            grouped_value[sub_key] = legacy_group_by_key(sub_value, 'station')
+
+        grouped_response[key] = grouped_value
+
+    return grouped_response
+
+
+def peak_allocation(func, rows) -> int:
+    # Returns the peak amount of bytes allocated while running func
+    tracemalloc.start()
+    func(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    for weeks in (1, 4, 16):
+        rows = generate_rows(weeks)
+
+        assert legacy_process_response(rows) == Fetcher.process_response(rows)
+
+        runs = 20
+        legacy_time = timeit.timeit(lambda: legacy_process_response(rows), number=runs) / runs
+        new_time = timeit.timeit(lambda: Fetcher.process_response(rows), number=runs) / runs
+
+        legacy_peak = peak_allocation(legacy_process_response, rows)
+        new_peak = peak_allocation(Fetcher.process_response, rows)
+
+        print(f'{weeks:>2} weeks, {len(rows):>5} rows: '
+              f'legacy {legacy_time * 1000:7.2f}ms {legacy_peak / 1024:8.0f}KiB peak, '
+              f'single pass {new_time * 1000:7.2f}ms {new_peak / 1024:8.0f}KiB peak, '
+              f'{legacy_time / new_time:.1f}x faster')
+
+
+if __name__ == '__main__':
+    main()
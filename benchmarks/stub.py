@@ -0,0 +1,104 @@
+'''
+A local stand in for the Sage REST endpoints SageScraper uses, so scrapes can be benchmarked
+end to end without a network or a Sage account
+'''
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from benchmarks.data import MenuGenerator
+
+# The access token every login gets
+ACCESS_TOKEN = 'benchmark-token'
+
+
+class SageStub:
+    '''
+    Serves a generated menu over HTTP on a free local port
+
+    generator: the MenuGenerator for the menu
+    cycle_length: how many weeks the menu has
+    first_date: the menuFirstDate of the menu, in MM/DD/YYYY format
+    unit_id: the school the menu belongs to
+    '''
+    def __init__(self, generator: MenuGenerator, cycle_length: int, first_date: str,
+                 unit_id: int = 1370):
+        self.generator = generator
+        self.cycle_length = cycle_length
+        self.first_date = first_date
+        self.unit_id = unit_id
+        self.last_update = '1564169917'
+        self.server = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self) -> str:
+        '''
+        Starts serving on a background thread, and returns the base url to give SageScraper
+        '''
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep alive, like Sage, so the scraper's session reuses its connections
+            protocol_version = 'HTTP/1.1'
+
+            #pylint: disable=invalid-name
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                resource = url.path.rsplit('/', 1)[-1]
+
+                if resource == 'getmenus':
+                    self.send_json({'error': False, 'menus': [stub.menu()]})
+                elif resource == 'checkMenuLastUpdate':
+                    self.send_json({'error': False,
+                                    'menuUpdate': query.get('lastUpdate') != [stub.last_update],
+                                    'newLastUpdate': stub.last_update})
+                elif resource == 'dataPull':
+                    self.send_json({'error': False, 'accessGranted': True})
+                else:
+                    self.send_json({'error': True, 'reason': 'Not Found'}, 404)
+
+            def do_POST(self):
+                resource = urlparse(self.path).path.rsplit('/', 1)[-1]
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                                     or b'{}')
+
+                if resource == 'login':
+                    self.send_json({'error': False, 'authSuccess': True,
+                                    'credentials': {'accessToken': ACCESS_TOKEN}})
+                elif resource == 'getmenuitems':
+                    self.send_json({'error': False,
+                                    'items': stub.generator.week(int(payload['week']))})
+                else:
+                    self.send_json({'error': True, 'reason': 'Not Found'}, 404)
+
+            def send_json(self, body: dict, status: int = 200):
+                body = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                #pylint: disable=redefined-builtin
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def menu(self) -> dict:
+        # The menu, as /getmenus describes it
+        return {'id': str(self.generator.menu_id), 'name': 'Benchmark School',
+                'showPrices': False, 'menuFirstDate': self.first_date,
+                'schoolId': str(self.unit_id), 'cycleLength': str(self.cycle_length),
+                'lastUpdate': self.last_update}
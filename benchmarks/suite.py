@@ -0,0 +1,265 @@
+'''
+Times the app's hot paths end to end at 1x, 10x and 100x the size of a normal menu, against a
+local stub of Sage, and writes the results as JSON so runs can be compared
+
+Run from the project root with: python -m benchmarks.suite
+    --scales 1,10,100: the data sizes to run, as multiples of a 16 week menu
+    --runs 20: how many times each read scenario runs
+    --output results.json: where to write the results
+    --compare old.json: results of an earlier run to compare against
+'''
+import argparse
+import json
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from os import path
+from flask import Flask, render_template
+from benchmarks.data import MenuGenerator
+from benchmarks.stub import SageStub
+from menu.cache import LRUCache
+from menu.fetch import Fetcher
+from menu.fragments import render_days
+from menu.migrations import upgrade
+from menu.models import SageMenuItem, db, enable_wal, get_data_version
+from menu.scrapers.sage import (DOT_TO_COLORS, STATION_TITLES, SageConfig, SageDateHandler,
+                                SageScraper)
+
+ROOT = path.join(path.dirname(path.realpath(__file__)), '..')
+
+# Sage menus usually run on a 16 week cycle, which is 1x
+BASE_WEEKS = 16
+
+TIMEZONE = 'America/Chicago'
+MEAL_TITLES = ['Breakfast', 'Lunch', 'Dinner']
+
+# Starts a read only app in a new interpreter and serves the home page once, like a new worker
+COLD_START_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+from menu.app import create_app
+app = create_app(sys.argv[1], read_only=True)
+created = time.perf_counter()
+app.test_client().get('/')
+print(json.dumps([(created - start) * 1000, (time.perf_counter() - created) * 1000]))
+'''
+
+# Cold starts take a whole interpreter each, so they run fewer times than the other scenarios
+COLD_START_RUNS = 5
+
+
+def build_app(db_path: str, menu_id: int) -> Flask:
+    '''
+    Builds an app with the same db setup and home page as menu/app.py, on its own db
+    '''
+    app = Flask(__name__, static_folder=path.join(ROOT, 'static'), static_url_path='/static',
+                template_folder=path.join(ROOT, 'templates'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    with app.app_context():
+        db.init_app(app)
+        enable_wal(db.engine)
+        upgrade(db)
+
+    # The caches are off, so every run does the real work
+    app.fetcher = Fetcher(db, TIMEZONE, MEAL_TITLES, cache_size=0, menu_id=menu_id)
+    app.day_fragments = LRUCache(0)
+
+    # Named like the home page route of menu/app.py, which the template links to
+    @app.route('/', endpoint='menu.index')
+    def index():
+        # Renders the home page like render_index in menu/app.py
+        version = get_data_version(db.session)
+        days = render_days(app.day_fragments, version, ('benchmark',), app.fetcher.fetch_days(5),
+                           titles=MEAL_TITLES, DOT_TO_COLORS=DOT_TO_COLORS,
+                           STATION_TITLES=STATION_TITLES)
+        return render_template('index.html', days=days, config={}, offset=0)
+
+    return app
+
+
+def time_runs(func, runs: int) -> dict:
+    '''
+    Calls func runs times, and returns timing stats in milliseconds
+    '''
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+
+    return summarize(times)
+
+
+def summarize(times: list) -> dict:
+    '''
+    Returns timing stats of a list of times in milliseconds
+    '''
+    return {'runs': len(times), 'min_ms': min(times), 'median_ms': statistics.median(times),
+            'mean_ms': statistics.mean(times), 'max_ms': max(times)}
+
+
+def time_cold_starts(db_path: str, menu_id: int, directory: str, runs: int) -> tuple:
+    '''
+    Times starting menu/app.py from scratch in new interpreters, on an existing db
+
+    returns: a tuple of timing stats for importing and creating the app, and for its first
+        request
+    '''
+    config_path = path.join(directory, 'cold-start.json')
+    with open(config_path, 'w') as f:
+        json.dump({'sage': {'email': 'benchmark@example.com', 'password': 'password',
+                            'unit_id': 0, 'menu_id': menu_id, 'menu_titles': MEAL_TITLES},
+                   'db_path': db_path, 'timezone': TIMEZONE}, f)
+
+    starts = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', COLD_START_SCRIPT, config_path], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout
+        starts.append(json.loads(output))
+
+    return (summarize([create_ms for create_ms, _ in starts]),
+            summarize([request_ms for _, request_ms in starts]))
+
+
+def run_scale(scale: int, runs: int, directory: str) -> list:
+    '''
+    Runs every scenario at a data size, on a new db
+
+    returns: a list of result dicts
+    '''
+    weeks = BASE_WEEKS * scale
+    # Half the menu is history, and scrapes fetch the other half, starting with this week
+    first_date = (date.today() - timedelta(weeks=weeks // 2)).strftime('%m/%d/%Y')
+
+    generator = MenuGenerator()
+    stub = SageStub(generator, weeks, first_date)
+    base_url = stub.start()
+
+    db_path = path.join(directory, f'scale-{scale}.sqlite3')
+    app = build_app(db_path, generator.menu_id)
+    sage_config = SageConfig('benchmark@example.com', 'password', stub.unit_id,
+                             generator.menu_id)
+    results = []
+
+    def record(scenario: str, stats: dict, rows: int):
+        results.append(dict(scenario=scenario, scale=scale, weeks=weeks, rows=rows, **stats))
+        print(f'{scenario:>18} {scale:>4}x {rows:>8} rows: median {stats["median_ms"]:10.2f}ms, '
+              f'min {stats["min_ms"]:10.2f}ms over {stats["runs"]} runs')
+
+    try:
+        with app.app_context():
+            scraper = SageScraper(sage_config, db, base_url=base_url)
+
+            # An end to end scrape of the current week onwards, through the stub
+            scraped = []
+            stats = time_runs(lambda: scraped.append(scraper.scrape()), 1)
+            record('scrape', stats, scraped[0])
+
+            # Saving every week of the menu, history included, a week at a time like scrape does,
+            # as the whole menu doesn't fit in memory at 100x
+            date_handler = SageDateHandler(weeks, first_date)
+            weeks_data = (scraper.format_data_for_storage(generator.week(week), date_handler)
+                          for week in range(weeks))
+
+            def save():
+                scraper.clear_staging()
+                for week_data in weeks_data:
+                    scraper.stage(week_data)
+                scraper.swap()
+
+            stats = time_runs(save, 1)
+            rows = db.session.query(SageMenuItem).count()
+            record('save', stats, rows)
+
+            fetcher = app.fetcher
+            record('fetch_valid_dates', time_runs(lambda: fetcher.fetch_valid_dates(5, 0), runs),
+                   rows)
+            record('fetch_days', time_runs(lambda: fetcher.fetch_days(5), runs), rows)
+            record('fetch_days_full', time_runs(lambda: fetcher.fetch_days(1, full=True), runs),
+                   rows)
+            record('wordify', time_runs(fetcher.wordify, runs), rows)
+
+            client = app.test_client()
+            record('index', time_runs(lambda: client.get('/'), runs), rows)
+
+            # The same, with every day already rendered, like paging or the 1pm rollover
+            app.day_fragments = LRUCache(256)
+            client.get('/')
+            record('index_cached_days', time_runs(lambda: client.get('/'), runs), rows)
+
+            # A new read only worker, from a bare interpreter to its first page
+            create_stats, request_stats = time_cold_starts(db_path, generator.menu_id, directory,
+                                                           min(runs, COLD_START_RUNS))
+            record('cold_start', create_stats, rows)
+            record('first_request', request_stats, rows)
+
+            db.session.remove()
+            db.engine.dispose()
+    finally:
+        stub.stop()
+
+    return results
+
+
+def get_commit() -> str:
+    # The commit being benchmarked, if this is a git checkout
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, old_path: str):
+    '''
+    Prints how each scenario's median time changed since an earlier run
+    '''
+    with open(old_path) as f:
+        old_results = {(result['scenario'], result['scale']): result
+                       for result in json.load(f)['results']}
+
+    print(f'\nCompared to {old_path}:')
+    for result in results:
+        old = old_results.get((result['scenario'], result['scale']))
+        if old:
+            print(f'{result["scenario"]:>18} {result["scale"]:>4}x: '
+                  f'{old["median_ms"]:10.2f}ms -> {result["median_ms"]:10.2f}ms, '
+                  f'{old["median_ms"] / result["median_ms"]:.2f}x faster')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the menu app against a Sage stub')
+    parser.add_argument('--scales', default='1,10,100',
+                        help='comma separated data sizes, as multiples of a 16 week menu')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='how many times each read scenario runs')
+    parser.add_argument('--output', help='where to write the results as JSON')
+    parser.add_argument('--compare', help='results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in (int(scale) for scale in args.scales.split(',')):
+            results += run_scale(scale, args.runs, directory)
+
+    report = {'created_at': datetime.utcnow().isoformat() + 'Z', 'commit': get_commit(),
+              'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+              'platform': platform.platform(), 'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
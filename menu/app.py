@@ -1,29 +1,56 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from datetime import date, datetime
+from functools import partial
+import hashlib
 import json
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+import click
 from os import path
-from flask import Flask, jsonify, render_template, request
+import time
+import pytz
+from flask import (Blueprint, Flask, Response, abort, current_app, g, jsonify, make_response,
+                   render_template, request, stream_with_context, url_for)
 from json import JSONEncoder
-import sentry_sdk
-from sentry_sdk.integrations.flask import FlaskIntegration
-from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
-from menu.models import db
-from menu.fetch import Fetcher
-from menu.scrapers.sage import SageConfig, SageScraper, DOT_TO_COLORS, STATION_TITLES
+from werkzeug.http import is_resource_modified
+from menu.assets import IMMUTABLE_MAX_AGE, StaticFingerprints, build_fingerprint
+from menu.cache import LRUCache
+from menu.compression import (COMPRESSIBLE_MIMETYPES, choose_encoding, compress_response,
+                              set_encoded_body)
+from menu.export import EXPORT_FORMATS, ExportError, decode_cursor, export_chunks
+from menu.filters import MenuFilter, MenuFilterError, parse_fields, parse_menu_filter
+from menu.fragments import render_days
+from menu.models import (SageMenuCycle, db, dispose_after_fork, enable_query_only, enable_wal,
+                         get_data_state, get_data_version, has_changes_since)
+from menu.migrations import upgrade
+from menu.jobs import ScrapeQueue
+from menu.metrics import format_server_timing, metrics, server_timings
+from menu.pagination import CursorError, cursor_window, page_cursors
+from menu.scheduler import ScrapeScheduler
+from menu.snapshots import SnapshotStore, make_snapshot
+from menu.scrapers.sage import DOT_TO_COLORS, STATION_TITLES, SageDateHandler
+from menu.tenants import Tenant, load_tenants
 
 current_dir = path.dirname(path.realpath(__file__))
 
-with open(path.join(current_dir, '../', 'config.json'), 'r') as f:
-    config = json.load(f)
+def load_config(config_path: str = None) -> dict:
+    '''
+    Reads config.json, with $HERE in paths replaced by the directory the config is in
 
-    # Replace $HERE in a db_path with the path of the config file
-    config['db_path'] = config['db_path'].replace('$HERE', path.join(current_dir, '..'))
+    config_path: (optional) the path of the config, defaults to config.json in the project root
+    '''
+    config_path = config_path or path.join(current_dir, '..', 'config.json')
+    config_dir = path.dirname(path.realpath(config_path))
 
-# If a sentry URL exists, enable sentry error reporting
-if 'sentry_dsn' in config:
-    sentry_sdk.init(
-        dsn=config['sentry_dsn'],
-        integrations=[FlaskIntegration(), SqlalchemyIntegration()]
-    )
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+
+    for key in ('db_path', 'snapshot_dir', 'archive_dir'):
+        if key in config:
+            config[key] = config[key].replace('$HERE', config_dir)
+
+    return config
 
 # Custom JSON Encoder for flask to format all dates in YYYY-MM-DD format
 class CustomJSONEncoder(JSONEncoder):
@@ -40,45 +67,406 @@ class CustomJSONEncoder(JSONEncoder):
             return list(iterable)
         return JSONEncoder.default(self, obj)
 
-app = Flask(__name__, static_folder='../static', static_url_path='/static', template_folder='../templates')
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{config["db_path"]}'
-# Turn off the track modifications setting for the db, as it's not used,
-# and by turning it off, we gain performance
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-# Use the custom json encoder defined above
-app.json_encoder = CustomJSONEncoder
+@dataclass
+class MenuState:
+    '''
+    Everything create_app sets up for an app besides the Flask app itself. Kept in
+    app.extensions['menu'], so each app has its own, see get_state
+
+    config dict: the loaded config.json
+    read_only bool: whether the app only serves the menu, see create_app
+    tenants OrderedDict: every menu the app serves, the first one is served at the root urls
+    static_fingerprints StaticFingerprints: hashes of static files, which go in their urls so
+        they can be cached forever
+    build_fingerprint str: a hash of the app's code, templates, static files and config, see
+        build_fingerprint
+    snapshot_store SnapshotStore: pre-rendered common pages, or None if snapshots are off
+    compressed_bodies LRUCache: compressed bodies of conditional_response, by ETag and content
+        encoding
+    static_bodies LRUCache: compressed static files, by filename, fingerprint and content
+        encoding, see compress_static_file
+    day_fragments LRUCache: each day of the home page, rendered, see render_days
+    scrape_queue ScrapeQueue: runs the app's scrapes
+    sage_accounts dict: Sage accounts by (email, password), kept for the life of the app so
+        scrapes reuse access tokens and connections
+    '''
+    config: dict
+    read_only: bool
+    tenants: OrderedDict
+    static_fingerprints: StaticFingerprints
+    build_fingerprint: str
+    snapshot_store: SnapshotStore
+    compressed_bodies: LRUCache
+    static_bodies: LRUCache
+    day_fragments: LRUCache
+    scrape_queue: ScrapeQueue = None
+    sage_accounts: dict = field(default_factory=dict)
+
+
+def get_state(app: Flask = None) -> MenuState:
+    '''
+    Returns the MenuState of an app, the current one by default
+    '''
+    return (app or current_app).extensions['menu']
+
+# The routes and commands of the app, added to it by create_app
+views = Blueprint('menu', __name__, cli_group=None)
+
+def create_app(config_path: str = None, read_only: bool = None) -> Flask:
+    '''
+    Builds the app. Nothing connects to the db once it returns, so it's safe to call before
+    forking workers, like with gunicorn --preload
+
+    config_path: (optional) the path of config.json, defaults to the one in the project root
+    read_only: (optional) whether this process only serves the menu, without creating or
+        migrating tables, scraping or writing to the db. Defaults to read_only in the config
+    '''
+    config = load_config(config_path)
+    if read_only is None:
+        read_only = config.get('read_only', False)
+
+    # If a sentry URL exists, enable sentry error reporting. Only imported then, as it's slow to
+    # import
+    if 'sentry_dsn' in config:
+        #pylint: disable=import-outside-toplevel
+        import sentry_sdk
+        from sentry_sdk.integrations.flask import FlaskIntegration
+        from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
+        sentry_sdk.init(
+            dsn=config['sentry_dsn'],
+            integrations=[FlaskIntegration(), SqlalchemyIntegration()]
+        )
+
+    app = Flask(__name__, static_folder='../static', static_url_path='/static',
+                template_folder='../templates')
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{config["db_path"]}'
+    # Turn off the track modifications setting for the db, as it's not used,
+    # and by turning it off, we gain performance
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Use the custom json encoder defined above
+    app.json_encoder = CustomJSONEncoder
+
+    with app.app_context():
+        db.init_app(app)
+        # Lets the menu be read while a scrape is writing to it
+        enable_wal(db.engine)
+        if read_only:
+            # Something else keeps the schema up to date, and nothing here should write
+            enable_query_only(db.engine)
+        else:
+            # Creates tables for a new db, or migrates an existing one to the latest schema
+            upgrade(db)
+
+        # Forked workers open their own connections instead of sharing these
+        dispose_after_fork(db.engine)
+        db.engine.dispose()
+
+    state = MenuState(
+        config=config, read_only=read_only,
+        tenants=load_tenants(config, db, read_only=read_only),
+        static_fingerprints=StaticFingerprints(app.static_folder),
+        # Hashed once here, so nothing has to be read again per request
+        build_fingerprint=build_fingerprint([app.root_path, app.static_folder,
+                                             path.join(app.root_path, app.template_folder)],
+                                            config),
+        snapshot_store=SnapshotStore(config.get('snapshot_dir')) if config.get('snapshots')
+        else None,
+        compressed_bodies=LRUCache(config.get('compressed_cache_size', 256)),
+        static_bodies=LRUCache(config.get('compressed_cache_size', 256)),
+        day_fragments=LRUCache(config.get('fragment_cache_size', 256)))
+    state.scrape_queue = ScrapeQueue(app, db, run_scrape_job)
+    app.extensions['menu'] = state
+
+    app.before_request(start_request_timer)
+    app.after_request(record_request_time)
+    # Runs before record_request_time, so compressing counts towards the time of the request
+    app.after_request(compress_and_cache)
+    app.url_defaults(fingerprint_static_url)
+    app.register_blueprint(views)
+
+    # The scheduler can also run inside the app, on a background thread
+    if config.get('scheduler', {}).get('in_process') and not read_only:
+        Thread(target=build_scheduler(config).run, args=(partial(scheduled_scrape, app),),
+               name='scrape-scheduler', daemon=True).start()
+
+    return app
+
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    # Collect the stages of this request for its Server-Timing header. It's set on every request,
+    # so nothing is left over from the last request on the same thread
+    server_timings.set({} if get_state().config.get('server_timing') else None)
+
+def record_request_time(response: Response) -> Response:
+    seconds = time.perf_counter() - g.request_start
+    metrics.observe('http_request_duration_seconds', seconds, endpoint=request.endpoint,
+                    status=response.status_code)
+
+    timings = server_timings.get()
+    if timings is not None:
+        timings['total'] = seconds * 1000
+        response.headers['Server-Timing'] = format_server_timing(timings)
+
+    return response
+
+def fingerprint_static_url(endpoint: str, values: dict):
+    # Every url_for('static', ...) gets a v arg with a hash of the file's content
+    if endpoint == 'static' and 'filename' in values:
+        values['v'] = get_state().static_fingerprints.get(values['filename'])
+
+def compress_and_cache(response: Response) -> Response:
+    state = get_state()
+    if (request.endpoint == 'static' and request.args.get('v') and request.args.get('v')
+            == state.static_fingerprints.get(request.view_args['filename'])):
+        # A fingerprinted url always has the same content, so it never has to be checked again.
+        # Flask marks static files no-cache by default, which would undo that
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+
+    if state.config.get('compression', True):
+        encoding = choose_encoding(request.accept_encodings)
+        if request.endpoint == 'static':
+            compress_static_file(response, encoding)
+        else:
+            # Anything conditional_response didn't compress already
+            compress_response(response, encoding)
+
+    return response
+
+# Static files don't change with the menu data, so their compressed bodies are all cached under
+# this one version
+STATIC_VERSION = 0
+
+def compress_static_file(response: Response, encoding: str):
+    '''
+    Compresses a static file's response. Compressed bodies are cached by the fingerprint of the
+    file, which changes with its content, so a changed file is never served from an old body
+    '''
+    if response.status_code != 200 or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        # Like a 304, part of a file for a range request, or an image that's compressed already
+        return
+
+    # Caches have to keep compressed and uncompressed copies apart
+    response.vary.add('Accept-Encoding')
+    if not encoding:
+        return
+
+    state = get_state()
+    filename = request.view_args['filename']
+    fingerprint = state.static_fingerprints.get(filename)
+    key = (filename, fingerprint, encoding)
+
+    body = state.static_bodies.get(key, STATIC_VERSION) if fingerprint else None
+    # Static files are streamed from disk, which compress_response leaves alone
+    response.direct_passthrough = False
+    if body:
+        # The cached body replaces the file, so let go of it
+        response.response.close()
+        set_encoded_body(response, body, encoding)
+        return
+
+    response.make_sequence()
+    # Without a fingerprint there's nothing to tell the file's content apart by, so it's
+    # compressed but not cached
+    if compress_response(response, encoding) and fingerprint:
+        state.static_bodies.set(key, response.get_data(), STATIC_VERSION)
+
+def get_tenant(slug: str) -> Tenant:
+    # Returns the tenant for a slug in a url, or the default tenant if there's no slug
+    tenants = get_state().tenants
+    if slug is None:
+        return next(iter(tenants.values()))
+
+    if slug not in tenants:
+        abort(404)
+
+    return tenants[slug]
+
+# The index page offsets that get pre-rendered, as they're the pages people actually look at
+SNAPSHOT_OFFSETS = (-10, -5, 0, 5, 10)
+
+def snapshot_response(tenant: Tenant, key: str, render) -> Response:
+    '''
+    Serves the snapshot stored under key if it's up to date, otherwise calls render and stores
+    the result as the new snapshot
+
+    tenant: the tenant the page belongs to
+    key: the snapshot key, or None if the page shouldn't be snapshotted
+    render: a function that takes no arguments and returns the response
+    '''
+    state = get_state()
+    snapshot_store = state.snapshot_store
+    if not snapshot_store or not key:
+        return render()
+
+    key = f'{tenant.slug}-{key}'
+    version = get_data_version(db.session)
+    default_date = tenant.fetcher.get_default_date()
+
+    snapshot = snapshot_store.get(key)
+
+    if (not snapshot or snapshot.version != version
+            or snapshot.default_date != default_date.strftime('%Y-%m-%d')
+            or snapshot.build != state.build_fingerprint):
+        # Either new data was scraped, it's past lunch time, or the app was deployed or
+        # reconfigured since, so render a new snapshot
+        metrics.inc('menu_cache_requests_total', cache='snapshot', result='miss')
+        rendered = make_response(render())
+        snapshot = make_snapshot(rendered.get_data(), rendered.mimetype, version, default_date,
+                                 state.build_fingerprint)
+        snapshot_store.put(key, snapshot)
+    else:
+        metrics.inc('menu_cache_requests_total', cache='snapshot', result='hit')
+
+    return Response(snapshot.body, mimetype=snapshot.mimetype)
+
+def conditional_response(tenant: Tenant, window: tuple, render) -> Response:
+    '''
+    Handles conditional GETs for a window of menu data. The ETag is made from the data version,
+    the window and the build fingerprint, so a 304 can be sent without querying or serializing
+    the menu data, but never for a page an older deploy or config rendered.
+    Responses can be cached until the default date rolls over, or for cache_max_age seconds
+
+    tenant: the tenant the menu data belongs to
+    window: a tuple of everything that determines the response, like (start date, days, offset)
+    render: a function that takes no arguments and returns the full response
+    '''
+    state = get_state()
+    version, updated_at = get_data_state(db.session)
+
+    etag = hashlib.sha1(repr((request.path, version, state.build_fingerprint) + window)
+                        .encode('utf-8')).hexdigest()
+    # The window moves when the default date rolls over, so that counts as a modification too
+    last_modified = tenant.fetcher.last_rollover().astimezone(pytz.utc).replace(tzinfo=None)
+    if updated_at:
+        last_modified = max(last_modified, updated_at)
+    # HTTP dates don't go smaller than seconds
+    last_modified = last_modified.replace(microsecond=0)
+
+    encoding = None
+    if state.config.get('compression', True):
+        encoding = choose_encoding(request.accept_encodings)
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        # The same ETag always has the same body, so it only has to be rendered and compressed
+        # once for each encoding
+        compressed = state.compressed_bodies.get((etag, encoding), version) if encoding else None
+        if compressed:
+            body, mimetype = compressed
+            response = Response(mimetype=mimetype)
+            set_encoded_body(response, body, encoding)
+        else:
+            response = make_response(render())
+            if compress_response(response, encoding):
+                state.compressed_bodies.set((etag, encoding),
+                                      (response.get_data(), response.mimetype), version)
+
+    # Compressed bodies only weakly match, see set_encoded_body
+    response.set_etag(etag, weak='Content-Encoding' in response.headers)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = min(tenant.fetcher.seconds_until_rollover(),
+                                         state.config.get('cache_max_age', 300))
+    return response
+
+def build_snapshots(tenant: Tenant):
+    '''
+    Pre-renders a tenant's most common pages, meant to run once a scrape finishes
+    '''
+    app = current_app._get_current_object()
+    for offset in SNAPSHOT_OFFSETS:
+        with app.test_request_context(f'/{tenant.slug}/', query_string={'offset': offset}):
+            snapshot_response(tenant, f'index{offset}', partial(render_index, tenant, offset))
+
+    with app.test_request_context(f'/{tenant.slug}/fetch'):
+        snapshot_response(tenant, 'fetch', partial(render_fetch, tenant, 1, 0, None, MenuFilter(),
+                                                   None))
+
+    with app.test_request_context(f'/{tenant.slug}/wordify'):
+        snapshot_response(tenant, 'wordify', partial(render_wordify, tenant))
+
+def get_page_cursors(tenant: Tenant, days: int, offset: int, start: date) -> tuple:
+    '''
+    Returns the (previous, next) cursors of a page of menu data, or (None, None) if the page was
+    found by offset and is empty, as there's no date to page from
+    '''
+    start = start or tenant.fetcher.get_default_date()
+    bounds = tenant.fetcher.fetch_page_bounds(days, offset, start)
+    if not bounds and offset:
+        return None, None
+
+    return page_cursors(bounds, start, days)
+
+def render_index(tenant: Tenant, offset: int, start: date = None, days: int = 5) -> str:
+    # Read before the menu data, so days are never cached under a newer version than their data
+    version = get_data_version(db.session)
+    menu_data = tenant.fetcher.fetch_days(days, offset=offset, start=start)
+    prev_cursor, next_cursor = get_page_cursors(tenant, days, offset, start)
+    # Pages reached by cursor aren't today's page, whatever their offset
+    paged = bool(start) or offset != 0
+
+    if not menu_data:
+        return render_template('notfound.html', offset=offset, paged=paged,
+                               prev_cursor=prev_cursor, next_cursor=next_cursor)
 
-with app.app_context():
-    db.init_app(app)
-    db.create_all()
+    with metrics.timer('render_template'):
+        rendered_days = render_days(get_state().day_fragments, version, (tenant.slug,), menu_data,
+                                    titles=tenant.sage['menu_titles'],
+                                    DOT_TO_COLORS=DOT_TO_COLORS, STATION_TITLES=STATION_TITLES)
+        return render_template('index.html', days=rendered_days, config=get_state().config,
+                               offset=offset, paged=paged, prev_cursor=prev_cursor,
+                               next_cursor=next_cursor)
 
-    global fetchster
-    fetchster = Fetcher(db, config['timezone'], config['sage']['menu_titles'])
+def render_fetch(tenant: Tenant, days: int, offset: int, start_date: date,
+                 menu_filter: MenuFilter, fields: tuple) -> Response:
+    menu_data = tenant.fetcher.fetch_days(days, start=start_date, offset=offset, full=True,
+                                          menu_filter=menu_filter, fields=fields)
+    with metrics.timer('serialize'):
+        return jsonify(menu_data)
 
-@app.route('/')
-def index():
+def render_wordify(tenant: Tenant, day: date = None, locale: str = None) -> Response:
+    return jsonify(tenant.fetcher.wordify(day, locale))
+
+@views.route('/', defaults={'tenant_slug': None})
+@views.route('/<tenant_slug>/')
+def index(tenant_slug: str):
     # The main webview for the menu
+    tenant = get_tenant(tenant_slug)
+
     if request.args.get('offset'):
         offset = int(request.args.get('offset'))
     else:
         offset = 0
 
-    menu_data = fetchster.fetch_days(5, offset=offset)
+    if request.args.get('cursor'):
+        # A cursor from the Back or Forward buttons, which takes over from the offset
+        try:
+            start_date, days = cursor_window(request.args.get('cursor'), 5)
+        except CursorError as error:
+            return str(error), 400
 
-    if not menu_data:
-        return render_template('notfound.html', offset=offset)
+        return conditional_response(tenant, (start_date, days, 0),
+                                    partial(render_index, tenant, 0, start_date, days))
 
-    return render_template('index.html', menu_data=menu_data, datetime=datetime,
-                           titles=config['sage']['menu_titles'], DOT_TO_COLORS=DOT_TO_COLORS,
-                           STATION_TITLES=STATION_TITLES, config=config, offset=offset)
+    key = f'index{offset}' if offset in SNAPSHOT_OFFSETS else None
+    return conditional_response(tenant, (tenant.fetcher.get_default_date(), 5, offset),
+                                partial(snapshot_response, tenant, key,
+                                        partial(render_index, tenant, offset)))
 
 
-@app.route('/fetch')
-def fetch():
+@views.route('/fetch', defaults={'tenant_slug': None})
+@views.route('/<tenant_slug>/fetch')
+def fetch(tenant_slug: str):
     # A simple fetch api to hit the DB
     # Accepts a days param for the amount of days
     # and a date param for the start date in YYYY-MM-DD format
-    # both parameters are optional
+    # both parameters are optional, as are the filters and fields projection
+    tenant = get_tenant(tenant_slug)
+
     if request.args.get('days'):
         days = int(request.args.get('days'))
         if days == 0:
@@ -99,28 +487,285 @@ def fetch():
         except ValueError:
             pass
 
-    return jsonify(fetchster.fetch_days(days, start=start_date, offset=offset))
+    if request.args.get('cursor'):
+        # A cursor from the Link header of another page, which takes over from date and offset
+        try:
+            start_date, days = cursor_window(request.args.get('cursor'), days)
+        except CursorError as error:
+            return str(error), 400
+        offset = 0
 
-@app.route('/wordify')
-def wordify():
+    try:
+        menu_filter = parse_menu_filter(request.args, tenant.sage['menu_titles'])
+        fields = parse_fields(request.args)
+    except MenuFilterError as error:
+        return str(error), 400
+
+    # Only the default, unfiltered window is snapshotted
+    key = 'fetch' if (days == 1 and offset == 0 and not start_date and not menu_filter
+                      and not fields) else None
+    response = conditional_response(tenant,
+                                    (start_date or tenant.fetcher.get_default_date(), days, offset,
+                                     menu_filter, fields),
+                                    partial(snapshot_response, tenant, key,
+                                            partial(render_fetch, tenant, days, offset, start_date,
+                                                    menu_filter, fields)))
+
+    if response.status_code == 200:
+        # Point to the pages before and after this one, with everything but the window kept
+        prev_cursor, next_cursor = get_page_cursors(tenant, days, offset, start_date)
+        if prev_cursor:
+            args = {name: values for name, values in request.args.lists()
+                    if name not in ('cursor', 'date', 'offset')}
+            links = [(url_for(request.endpoint, **request.view_args, **args, cursor=cursor), rel)
+                     for cursor, rel in ((prev_cursor, 'prev'), (next_cursor, 'next'))]
+            response.headers['Link'] = ', '.join(f'<{url}>; rel="{rel}"' for url, rel in links)
+            response.headers['X-Prev-Cursor'] = prev_cursor
+            response.headers['X-Next-Cursor'] = next_cursor
+
+    return response
+
+@views.route('/wordify', defaults={'tenant_slug': None})
+@views.route('/<tenant_slug>/wordify')
+def wordify(tenant_slug: str):
     # An endpoint for a human readable description of the menu
-    return jsonify(fetchster.wordify())
+    # Accepts a date param for the date in YYYY-MM-DD format, and a locale param for the language,
+    # both parameters are optional
+    tenant = get_tenant(tenant_slug)
+
+    day = None
+    if request.args.get('date'):
+        try:
+            day = datetime.strptime(request.args.get('date'), '%Y-%m-%d').date()
+        except ValueError:
+            return 'Invalid Date', 400
+
+    locale = request.args.get('locale')
+    if locale and locale not in tenant.fetcher.wordify_locales:
+        return f'Unknown Locale, try one of {", ".join(tenant.fetcher.wordify_locales)}', 400
+
+    # Only the default date in the default locale is snapshotted
+    key = 'wordify' if not day and not locale else None
+    return conditional_response(tenant, (tenant.fetcher.get_default_date(), day, locale),
+                                partial(snapshot_response, tenant, key,
+                                        partial(render_wordify, tenant, day, locale)))
+
+@views.route('/export', defaults={'tenant_slug': None})
+@views.route('/<tenant_slug>/export')
+def export(tenant_slug: str):
+    # A bulk export of menu items, streamed a chunk at a time as NDJSON or CSV
+    # Accepts from and to params for the (inclusive) date range in YYYY-MM-DD format,
+    # a format param, a cursor param to carry on an earlier export, a limit param,
+    # and the same filters as /fetch. Every parameter is optional
+    tenant = get_tenant(tenant_slug)
+
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return f'Unknown Format, try one of {", ".join(EXPORT_FORMATS)}', 400
+
+    try:
+        start, end = [datetime.strptime(request.args[arg], '%Y-%m-%d').date()
+                      if request.args.get(arg) else None for arg in ('from', 'to')]
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+    except ValueError:
+        return 'Invalid Date Range or Limit', 400
+
+    try:
+        after = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        menu_filter = parse_menu_filter(request.args, tenant.sage['menu_titles'])
+    except (ExportError, MenuFilterError) as error:
+        return str(error), 400
+
+    items = tenant.fetcher.export(start, end, after=after, limit=limit, menu_filter=menu_filter)
+    # The db session has to outlive the view, as rows are read while the response is sent
+    return Response(stream_with_context(export_chunks(items, export_format)),
+                    mimetype=EXPORT_FORMATS[export_format])
+
+# The most search results a page can have
+MAX_PER_PAGE = 100
+
+@views.route('/search', defaults={'tenant_slug': None})
+@views.route('/<tenant_slug>/search')
+def search(tenant_slug: str):
+    # Searches every menu item ever scraped by name, newest first
+    # Accepts a q param with the search text, and page and per_page params for pagination
+    tenant = get_tenant(tenant_slug)
+
+    query = request.args.get('q', '').strip()
+    if not query:
+        return 'Missing Search Query', 400
+
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', 20)), 1), MAX_PER_PAGE)
+    except ValueError:
+        return 'Invalid Page', 400
+
+    def render():
+        results = tenant.fetcher.search(query, page, per_page)
+        results.update(query=query, page=page, per_page=per_page, next_page=None)
+        if page * per_page < results['total']:
+            results['next_page'] = url_for('.search', tenant_slug=tenant_slug, q=query,
+                                           page=page + 1, per_page=per_page)
+        return jsonify(results)
 
-@app.route('/scrape', methods=['POST'])
+    return conditional_response(tenant, (query, page, per_page), render)
+
+@views.route('/next/<int:recipe_id>', defaults={'tenant_slug': None})
+@views.route('/<tenant_slug>/next/<int:recipe_id>')
+def next_occurrence(tenant_slug: str, recipe_id: int):
+    # Finds the next time a recipe is on the menu, starting from the default date
+    tenant = get_tenant(tenant_slug)
+
+    def render():
+        occurrence = tenant.fetcher.next_occurrence(recipe_id)
+        if not occurrence:
+            return 'Recipe Not On The Menu Again', 404
+        return jsonify(occurrence)
+
+    return conditional_response(tenant, (tenant.fetcher.get_default_date(), recipe_id), render)
+
+@views.route('/changes', defaults={'tenant_slug': None})
+@views.route('/<tenant_slug>/changes')
+def changes(tenant_slug: str):
+    # Lists what changed in the menu since a data version, for clients that keep a copy of it
+    # Accepts a since param with the version from the client's last sync, 0 for everything
+    tenant = get_tenant(tenant_slug)
+
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return 'Invalid Version', 400
+
+    return conditional_response(tenant, (since,),
+                                lambda: jsonify(tenant.fetcher.fetch_changes(since)))
+
+def run_scrape_job(job_id: str) -> int:
+    '''
+    Runs on the scrape queue's thread. Scrapes every tenant at once, sharing logins between
+    tenants with the same Sage account, and reports every finished week to the job
+
+    returns: the amount of menu items saved across every tenant
+    '''
+    #pylint: disable=import-outside-toplevel
+    # Only imported once there's a scrape, so workers that never scrape don't load requests
+    from menu.scrapers.sage import SageScraper, share_accounts
+
+    app = current_app._get_current_object()
+    state = get_state(app)
+    tenants = state.tenants
+    sage_configs = [tenant.build_sage_config(archive_dir=state.config.get('archive_dir'))
+                    for tenant in tenants.values()]
+    accounts = share_accounts(sage_configs, state.sage_accounts)
+
+    def scrape_tenant(tenant: Tenant, sage_config, account) -> int:
+        # Each tenant runs on its own thread, which needs its own app context for the db
+        with app.app_context():
+            sage_scraper = SageScraper(sage_config, db, account=account,
+                                       progress=partial(state.scrape_queue.report_progress,
+                                                        job_id, tenant.slug))
+            # Spoken menus go first, so the wordify snapshot is a lookup too
+            sage_scraper.add_post_scrape_hook(tenant.fetcher.store_wordify)
+            if state.snapshot_store:
+                sage_scraper.add_post_scrape_hook(partial(build_snapshots, tenant))
+            return sage_scraper.scrape()
+
+    with ThreadPoolExecutor(max_workers=len(tenants)) as executor:
+        futures = [executor.submit(scrape_tenant, tenant, sage_config, account)
+                   for tenant, sage_config, account in zip(tenants.values(), sage_configs,
+                                                           accounts)]
+
+    # Every tenant has finished by now, so one failing tenant doesn't stop the others,
+    # but it does fail the job
+    return sum(future.result() for future in futures)
+
+def scheduled_scrape(app: Flask) -> tuple:
+    '''
+    Runs a scrape through the scrape queue for the scheduler, and returns the outcome
+    and the current week of the menu cycle
+    '''
+    with app.app_context():
+        state = get_state(app)
+        # Rewriting weeks that didn't change still bumps the version, so changes are told apart
+        # by the change log instead
+        version = get_data_version(db.session)
+        job = state.scrape_queue.wait(state.scrape_queue.submit())
+
+        if not job or job['status'] == 'failed':
+            return ScrapeScheduler.ERROR, None
+
+        changed = has_changes_since(db.session, version)
+
+        # Worked out from the cycle each menu last had in Sage, as incremental scrapes skip weeks.
+        # The menu earliest in its cycle decides, so early_weeks applies if any menu is early
+        menu_ids = [tenant.sage['menu_id'] for tenant in state.tenants.values()]
+        weeks = [SageDateHandler(cycle_length, first_date).get_current_week()
+                 for cycle_length, first_date in db.session.query(
+                     SageMenuCycle.c.cycle_length, SageMenuCycle.c.first_date).filter(
+                         SageMenuCycle.c.menu_id.in_(menu_ids))]
+        current_week = min(weeks) if weeks else None
+
+    if changed:
+        return ScrapeScheduler.CHANGED, current_week
+    return ScrapeScheduler.UNCHANGED, current_week
+
+def build_scheduler(config: dict) -> ScrapeScheduler:
+    return ScrapeScheduler(config['timezone'], **{key: value for key, value in
+                                                  config.get('scheduler', {}).items()
+                                                  if key != 'in_process'})
+
+@views.cli.command('scrape')
+def scrape_command():
+    '''
+    Scrapes Sage once
+    '''
+    scrape_queue = get_state().scrape_queue
+    job = scrape_queue.wait(scrape_queue.submit())
+    click.echo(json.dumps(job, indent=2))
+
+@views.cli.command('reingest')
+@click.argument('archive_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('--processes', type=int, help='How many processes parse weeks, defaults to the '
+                                            'amount of CPUs')
+@click.option('--batch-size', type=int, default=5000, show_default=True,
+              help='How many menu items to write at once')
+def reingest_command(archive_dir: str, processes: int, batch_size: int):
+    '''
+    Rebuilds the menu data in the db from an archive of raw Sage weeks, without Sage
+    '''
+    #pylint: disable=import-outside-toplevel
+    from menu.archive import reingest
+
+    start = time.perf_counter()
+    saved_count = reingest(archive_dir, db, processes=processes, batch_size=batch_size,
+                           progress=lambda menu_id, weeks, items: click.echo(
+                               f'Menu {menu_id}: {items} menu items from {weeks} weeks'))
+    click.echo(f'Saved {saved_count} menu items in {time.perf_counter() - start:.2f}s')
+
+@views.cli.command('schedule')
+def schedule_command():
+    '''
+    Scrapes Sage forever, on an adaptive schedule
+    '''
+    build_scheduler(get_state().config).run(partial(scheduled_scrape,
+                                                   current_app._get_current_object()))
+
+@views.route('/scrape', methods=['POST'])
 def scrape():
     # A function to scrape the Sage if authentication is provided
+    state = get_state()
+    if state.read_only:
+        return 'This Worker Is Read Only', 501
+
     # First check and see if the scrape_key actually exists
-    if 'scrape_key' in config:
+    if 'scrape_key' in state.config:
         # If so, check if the user provided scrape key matches our scrape key
-        if request.form.get('scrape_key') == config['scrape_key']:
-            # If so, do some exciting scrpaing
-            sage_config = SageConfig(config['sage']['email'], config['sage']['password'],
-                                     config['sage']['unit_id'], config['sage']['menu_id'])
-
-            sage_scraper = SageScraper(sage_config, db)
-            sage_scraper.scrape()
-            # Then return nothing, yes
-            return '', 204
+        if request.form.get('scrape_key') == state.config['scrape_key']:
+            # If so, queue up some exciting scraping, and tell the user where to check on it
+            job_id = state.scrape_queue.submit()
+            status_url = url_for('.scrape_status', job_id=job_id)
+            return jsonify({'job_id': job_id, 'status_url': status_url}), 202, {
+                'Location': status_url}
 
         # If not, tell the user that they did it wrong
         return 'Incorrect/Missing Scrape Key', 401
@@ -128,5 +773,22 @@ def scrape():
     # If not, tell the user that we did it wrong
     return 'No Scrape Key in config.json 🤷', 501
 
+@views.route('/metrics')
+def metrics_endpoint():
+    # Every metric of this worker, in the Prometheus text format
+    if not get_state().config.get('metrics', True):
+        abort(404)
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@views.route('/scrape/<job_id>')
+def scrape_status(job_id: str):
+    # Reports on a scrape job queued by /scrape
+    job = get_state().scrape_queue.get(job_id)
+    if not job:
+        return 'Scrape Job Not Found', 404
+
+    return jsonify(job)
+
 if __name__ == "__main__":
-    app.run()
+    create_app().run()
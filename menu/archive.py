@@ -0,0 +1,105 @@
+'''
+Rebuilds menu data from an archive of raw Sage weeks, written by scrapes with an archive_dir,
+without Sage. Parsing is spread over several processes, and the db is written in big batches
+'''
+import gzip
+import json
+import os
+from multiprocessing import Pool
+from os import path
+from flask_sqlalchemy import SQLAlchemy
+from menu.scrapers.sage import ARCHIVE_SUFFIX, SageConfig, SageDateHandler, SageScraper
+
+def find_latest_weeks(archive_dir: str) -> dict:
+    '''
+    Finds the newest archived fetch of every week of every menu, as later fetches of a week
+    replace earlier ones, like they do when scraping
+
+    archive_dir: the archive directory, laid out like SageScraper.archive_week writes it
+
+    returns: a dict of menu id to a list of archive file paths, oldest week first
+    '''
+    latest_weeks = {}
+    for menu_id in sorted(os.listdir(archive_dir)):
+        menu_dir = path.join(archive_dir, menu_id)
+        if not menu_id.isdigit() or not path.isdir(menu_dir):
+            continue
+
+        # Week directories are named after their Sunday in ISO format, and files after their
+        # fetch time, so they sort in time order
+        for week_start in sorted(os.listdir(menu_dir)):
+            week_dir = path.join(menu_dir, week_start)
+            fetches = sorted(file_name for file_name in os.listdir(week_dir)
+                             if file_name.endswith(ARCHIVE_SUFFIX))
+            if fetches:
+                latest_weeks.setdefault(int(menu_id), []).append(
+                    path.join(week_dir, fetches[-1]))
+
+    return latest_weeks
+
+def read_week(file_path: str) -> list:
+    '''
+    Reads an archived week and formats it for storage, the same way a scrape would. Runs in the
+    worker processes of reingest
+
+    file_path: the path of the archive file
+
+    returns: a list of formatted menu items
+    '''
+    with gzip.open(file_path, 'rt', encoding='utf-8') as f:
+        archived = json.load(f)
+
+    if not archived['items']:
+        return []
+
+    date_handler = SageDateHandler(int(archived['menu']['cycleLength']),
+                                   archived['menu']['menuFirstDate'])
+    return SageScraper.format_data_for_storage(archived['items'], date_handler)
+
+def reingest(archive_dir: str, db: SQLAlchemy, processes: int = None, batch_size: int = 5000,
+             progress=None) -> int:
+    '''
+    Saves the newest archived fetch of every week in an archive to the db, replacing whatever the
+    db had for those dates. Has to be called in an app context
+
+    archive_dir: the archive directory
+    db: SQLAlchemy Instance to store menu data in
+    processes: (optional) how many processes parse weeks, defaults to the amount of CPUs
+    batch_size: how many menu items to write to the staging table at once
+    progress: (optional) a function called with the menu id, the amount of weeks and the amount
+        of menu items saved, every time a menu is done
+
+    returns: the amount of menu items saved
+    '''
+    latest_weeks = find_latest_weeks(archive_dir)
+    saved_count = 0
+
+    with Pool(processes) as pool:
+        for menu_id, file_paths in latest_weeks.items():
+            # Only the menu id and batch size are used, as nothing is fetched from Sage
+            scraper = SageScraper(SageConfig('', '', 0, menu_id, batch_size=batch_size), db)
+            scraper.clear_staging()
+
+            pending_items = []
+            staged_count = 0
+            # Weeks are parsed in the other processes while this one writes earlier weeks
+            for week_items in pool.imap(read_week, file_paths):
+                pending_items += week_items
+                if len(pending_items) >= batch_size:
+                    scraper.stage(pending_items)
+                    staged_count += len(pending_items)
+                    pending_items = []
+
+            if pending_items:
+                scraper.stage(pending_items)
+                staged_count += len(pending_items)
+
+            # Every week of the menu is swapped in at once, in a single transaction
+            if staged_count:
+                scraper.swap()
+
+            saved_count += staged_count
+            if progress:
+                progress(menu_id, len(file_paths), staged_count)
+
+    return saved_count
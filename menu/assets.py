@@ -0,0 +1,67 @@
+import hashlib
+import json
+import os
+from threading import Lock
+
+# How long browsers may keep fingerprinted static files, as their url changes with their content
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def build_fingerprint(directories: list, config: dict) -> str:
+    '''
+    Returns a short hash of every file under some directories, along with the config. Anything
+    cached by it, like ETags, changes once a deploy or config change could change what's served
+
+    directories: the directories the app is served from, like its code, templates and static files
+    config: the loaded config.json
+    '''
+    build_hash = hashlib.sha1()
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            # Walk in a set order so every worker comes up with the same hash
+            dirs[:] = sorted(name for name in dirs if name != '__pycache__')
+            for filename in sorted(files):
+                file_path = os.path.join(root, filename)
+                build_hash.update(os.path.relpath(file_path, directory).encode('utf-8'))
+                with open(file_path, 'rb') as f:
+                    build_hash.update(f.read())
+
+    build_hash.update(json.dumps(config, sort_keys=True, default=str).encode('utf-8'))
+    return build_hash.hexdigest()[:12]
+
+
+class StaticFingerprints:
+    '''
+    Hashes the content of static files, so their urls can change whenever they do, and they can
+    be cached forever. Hashes are kept until a file's modification time changes
+    '''
+    def __init__(self, static_folder: str):
+        '''
+        static_folder: the directory static files are served from
+        '''
+        self.static_folder = static_folder
+        # filename: (modification time, fingerprint)
+        self.fingerprints = {}
+        self.lock = Lock()
+
+    def get(self, filename: str) -> str:
+        '''
+        Returns a short hash of a static file's content, or None if there's no such file
+        '''
+        file_path = os.path.join(self.static_folder, filename)
+        try:
+            mtime = os.stat(file_path).st_mtime
+        except OSError:
+            return None
+
+        with self.lock:
+            cached_mtime, fingerprint = self.fingerprints.get(filename, (None, None))
+        if cached_mtime == mtime:
+            return fingerprint
+
+        with open(file_path, 'rb') as f:
+            fingerprint = hashlib.sha1(f.read()).hexdigest()[:12]
+
+        with self.lock:
+            self.fingerprints[filename] = (mtime, fingerprint)
+        return fingerprint
@@ -0,0 +1,53 @@
+from collections import OrderedDict
+from threading import Lock
+
+class LRUCache:
+    '''
+    A small thread safe least recently used cache, tied to a data version.
+
+    Whenever a different version is seen, everything cached for the old version is dropped
+    '''
+    def __init__(self, maxsize: int):
+        '''
+        maxsize: the max amount of entries to keep, 0 disables caching
+        '''
+        self.maxsize = maxsize
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, version: int):
+        '''
+        Returns the cached value for key at the provided data version, or None if missing
+        '''
+        with self.lock:
+            if version != self.version:
+                # The data changed, so nothing cached is accurate anymore
+                self.entries.clear()
+                self.version = version
+                return None
+
+            if key not in self.entries:
+                return None
+
+            # Mark the key as the most recently used
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value, version: int):
+        '''
+        Caches a value for key, evicting the least recently used entry if full
+        '''
+        if self.maxsize <= 0:
+            return
+
+        with self.lock:
+            if version != self.version:
+                # Don't cache data computed against a version we already moved past (or ahead of)
+                return
+
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
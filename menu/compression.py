@@ -0,0 +1,85 @@
+import gzip
+from flask import Response
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, without it responses are only gzipped
+    brotli = None
+
+# The mimetypes worth compressing. Images and fonts are compressed already
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/csv',
+                          'text/css', 'image/svg+xml'}
+
+# Bodies smaller than this barely shrink, and can even grow
+MIN_COMPRESS_SIZE = 500
+
+# Compressed bodies are usually reused, so it's worth compressing them well
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+def choose_encoding(accept_encodings) -> str:
+    '''
+    Picks the best content encoding a client accepts, brotli if it's installed, then gzip
+
+    accept_encodings: the request's accept_encodings
+
+    returns: 'br', 'gzip', or None if the client accepts neither
+    '''
+    if brotli and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def compress(body: bytes, encoding: str) -> bytes:
+    '''
+    Compresses a body with a content encoding from choose_encoding
+    '''
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    # A fixed mtime keeps the output the same for the same body
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+def is_compressible(response: Response) -> bool:
+    '''
+    Returns True if a response is a complete body of a compressible mimetype that isn't
+    compressed yet. Streamed responses, like /export, are left alone
+    '''
+    return (response.status_code == 200 and not response.is_streamed
+            and not response.direct_passthrough and 'Content-Encoding' not in response.headers
+            and response.mimetype in COMPRESSIBLE_MIMETYPES)
+
+def compress_response(response: Response, encoding: str) -> bool:
+    '''
+    Compresses a response's body in place, if it's worth it
+
+    response: the response to compress
+    encoding: a content encoding from choose_encoding, or None
+
+    returns: True if the response was compressed
+    '''
+    if not is_compressible(response):
+        return False
+
+    # Caches have to keep compressed and uncompressed copies apart
+    response.vary.add('Accept-Encoding')
+
+    body = response.get_data()
+    if not encoding or len(body) < MIN_COMPRESS_SIZE:
+        return False
+
+    set_encoded_body(response, compress(body, encoding), encoding)
+    return True
+
+def set_encoded_body(response: Response, body: bytes, encoding: str):
+    '''
+    Gives a response an already compressed body
+    '''
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+
+    # Compressed bodies differ byte for byte, so their ETag is only weakly the same
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
@@ -0,0 +1,81 @@
+import base64
+import binascii
+import csv
+import io
+import json
+from datetime import datetime
+from itertools import islice
+from menu.filters import ITEM_FIELDS
+
+# The formats menu data can be exported in, and their mimetypes
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+# How many rows are sent to the client at a time
+CHUNK_SIZE = 500
+
+def encode_cursor(item: dict) -> str:
+    '''
+    Makes the cursor for an exported menu item, which resumes an export right after it
+    '''
+    position = [item['date'].strftime('%Y-%m-%d'), item['meal'], item['station'], item['id']]
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode(
+        'ascii').rstrip('=')
+
+def decode_cursor(cursor: str) -> tuple:
+    '''
+    Turns a cursor from encode_cursor back into the (date, meal, station, id) it was made from
+
+    raises ExportError if the cursor isn't one
+    '''
+    try:
+        # The padding is stripped to keep cursors url friendly, so it has to be put back
+        position = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        date, meal, station, item_id = position
+        return (datetime.strptime(date, '%Y-%m-%d').date(), int(meal), int(station),
+                int(item_id))
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ExportError('Invalid Cursor') from None
+
+def export_chunks(items, export_format: str):
+    '''
+    Formats exported menu items into chunks of text, CHUNK_SIZE rows at a time, so a response
+    can be streamed without holding the whole export in memory. Every row gets a cursor field,
+    so an interrupted export can carry on after the last row that made it
+
+    items: an iterable of menu item dicts, from Fetcher.export
+    export_format: one of EXPORT_FORMATS
+    '''
+    items = iter(items)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if export_format == 'csv':
+        # The header goes out with the first chunk
+        writer.writerow(ITEM_FIELDS + ('cursor',))
+
+    while True:
+        chunk = list(islice(items, CHUNK_SIZE))
+
+        if export_format == 'csv':
+            for item in chunk:
+                writer.writerow([item[field] for field in ITEM_FIELDS] + [encode_cursor(item)])
+            text = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        else:
+            text = ''.join(json.dumps(dict(item, date=item['date'].strftime('%Y-%m-%d'),
+                                           cursor=encode_cursor(item))) + '\n'
+                           for item in chunk)
+
+        if text:
+            yield text
+
+        # A short chunk means the items ran out
+        if len(chunk) < CHUNK_SIZE:
+            return
+
+
+class ExportError(BaseException):
+    '''
+    An exception to be used when an export request doesn't make sense
+    '''
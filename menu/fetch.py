@@ -1,18 +1,70 @@
-from datetime import timedelta, datetime
-from itertools import groupby
+import json
+import re
+from datetime import timedelta, datetime, time
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select, text, tuple_
 import pytz
-from menu.models import SageMenuItem
-from menu.scrapers.sage import STATION_TITLES
+from menu.cache import LRUCache
+from menu.filters import MenuFilter
+from menu.metrics import metrics
+from menu.models import (RecipeSearch, SageChange, SageMenuItem, SageRecipe, SageRecipeChange,
+                         SageWordify, ServedDate, get_change_log_start, get_data_version)
+from menu.wordify import build_wordify_text
+
+# The order menu items are grouped in: by day, then meal, then station. Items in a station
+# stay in the order Sage gave them ids
+GROUPING_ORDER = (SageMenuItem.c.date, SageMenuItem.c.meal, SageMenuItem.c.station,
+                  SageMenuItem.c.id)
+
+# The only columns the web view and wordify use
+DISPLAY_COLUMNS = (SageMenuItem.c.id, SageMenuItem.c.date, SageMenuItem.c.meal,
+                   SageMenuItem.c.station, SageMenuItem.c.card, SageMenuItem.c.dot,
+                   SageRecipe.c.name)
+
+# Every column of a menu item, as served by /fetch. Allergens are read in the order Sage lists
+# them, and formatted by format_allergens
+FULL_COLUMNS = tuple(column for column in SageMenuItem.c if column.name != 'misc') + (
+    SageRecipe.c.name, SageRecipe.c.allergen_ids.label('allergens'), SageMenuItem.c.misc)
+
+# The columns for each field of a menu item, so a fields projection can pick out just those
+COLUMNS_BY_FIELD = {column.name: column for column in FULL_COLUMNS}
+
+# The columns search results and next occurrences have
+OCCURRENCE_COLUMNS = (SageMenuItem.c.id, SageMenuItem.c.recipe_id, SageRecipe.c.name,
+                      SageMenuItem.c.date, SageMenuItem.c.meal, SageMenuItem.c.station)
+
+# The columns of menu items and recipes in /changes. Items refer to their recipe by id, so
+# recipes are only sent once
+CHANGE_ITEM_COLUMNS = tuple(column for column in SageMenuItem.c if column.name != 'menu_id')
+CHANGE_RECIPE_COLUMNS = (SageRecipe.c.recipe_id, SageRecipe.c.name,
+                         SageRecipe.c.allergen_ids.label('allergens'))
+
+# The fields process_response groups menu items by
+GROUPING_FIELDS = ('date', 'meal', 'station')
 
 class Fetcher:
     '''
     A class to handle all the menu data fetching for the app
     '''
-    def __init__(self, db: SQLAlchemy, timezone: str, meal_titles: list):
+    # The hour (in the provided timezone) after which the default date becomes tomorrow
+    ROLLOVER_HOUR = 13
+
+    # How many dates store_wordify reads from the db at a time
+    WORDIFY_BATCH_DAYS = 31
+
+    def __init__(self, db: SQLAlchemy, timezone: str, meal_titles: list, cache_size: int = 128,
+                 menu_id: int = None, wordify_locales: list = ('en',), read_only: bool = False):
         # Fetches the db from the models file, initalizes the database, and creates tables
         self.db = db
         self.meal_titles = meal_titles
+        # The locales spoken menus are made in, see WORDIFY_LOCALES. The first is the default
+        self.wordify_locales = list(wordify_locales)
+        # The Sage menu to fetch data for, or None for every menu in the db
+        self.menu_id = menu_id
+        # Grouped fetch_days results, dropped whenever a scrape saves new data
+        self.cache = LRUCache(cache_size)
+        # Whether to never write to the db, like spoken menus made on the fly
+        self.read_only = read_only
 
         self.timezone = pytz.timezone(timezone)
 
@@ -26,11 +78,39 @@ class Fetcher:
 
         # If it's after lunch time (1pm or after), go ahead and start with the following day
         # maybe the end time should be configurable
-        if start.hour >= 13:
+        if start.hour >= self.ROLLOVER_HOUR:
             start += timedelta(days=1)
 
         return start.date()
 
+    def next_rollover(self) -> datetime:
+        '''
+        Returns the timezone aware time at which get_default_date will next return a different date
+        '''
+        now = datetime.now(self.timezone)
+
+        rollover = self.timezone.localize(datetime.combine(now.date(), time(self.ROLLOVER_HOUR)))
+        if now >= rollover:
+            # Already past today's rollover, so the next one is tomorrow
+            rollover = self.timezone.localize(
+                datetime.combine(now.date() + timedelta(days=1), time(self.ROLLOVER_HOUR)))
+
+        return rollover
+
+    def last_rollover(self) -> datetime:
+        '''
+        Returns the timezone aware time at which get_default_date started returning its current date
+        '''
+        next_rollover = self.next_rollover()
+        return self.timezone.localize(
+            datetime.combine(next_rollover.date() - timedelta(days=1), time(self.ROLLOVER_HOUR)))
+
+    def seconds_until_rollover(self) -> int:
+        '''
+        Returns how many seconds are left until get_default_date returns a different date
+        '''
+        return max(int((self.next_rollover() - datetime.now(self.timezone)).total_seconds()), 0)
+
     def fetch_valid_dates(self, days: int, offset: int, descending: bool = False,
                           start: datetime.date = None) -> list:
         '''
@@ -52,16 +132,20 @@ class Fetcher:
         if not start:
             start = self.get_default_date()
 
-        if descending:
-            dates = self.db.session.query(SageMenuItem.c.date).distinct().filter(
-                SageMenuItem.c.date <= start).order_by(SageMenuItem.c.date.desc()).limit(
-                    days+abs(offset)).all()
-        else:
-            # The statement below queries for all distinct date values, filters to get only ones
-            # after the start, orders them in ascending order, sets a limit equalling the days param
-            dates = self.db.session.query(SageMenuItem.c.date).distinct().filter(
-                SageMenuItem.c.date >= start).order_by(SageMenuItem.c.date).limit(
-                    days+abs(offset)).all()
+        query = self.db.session.query(ServedDate.c.date).distinct()
+        if self.menu_id is not None:
+            query = query.filter(ServedDate.c.menu_id == self.menu_id)
+
+        with metrics.timer('fetch_valid_dates'):
+            if descending:
+                dates = query.filter(ServedDate.c.date <= start).order_by(
+                    ServedDate.c.date.desc()).limit(days+abs(offset)).all()
+            else:
+                # The statement below queries for all distinct date values, filters to get only
+                # ones after the start, orders them in ascending order, sets a limit equalling the
+                # days param
+                dates = query.filter(ServedDate.c.date >= start).order_by(
+                    ServedDate.c.date).limit(days+abs(offset)).all()
 
         dates = dates[abs(offset):]
 
@@ -69,114 +153,460 @@ class Fetcher:
         return [i[0] for i in dates]
 
 
-    def fetch_days(self, days: int, offset: int = 0, start: datetime.date = None) -> dict:
+    def fetch_days(self, days: int, offset: int = 0, start: datetime.date = None,
+                   full: bool = False, menu_filter: MenuFilter = None,
+                   fields: tuple = None) -> dict:
         '''
         Accepts day count and optional start date and returns menu items grouped by day, meal, and
         station
+
+        Menu items only have the columns needed to display them, unless full is True, in which case
+        they have every column, with allergens as a JSON list like Sage sends them
+
+        menu_filter: only keep the menu items that pass these filters. Days are still counted by
+            the dates with any menu, so a day where nothing passes is left out
+        fields: only give menu items these fields (see COLUMNS_BY_FIELD), instead of the ones
+            picked by full
+
+        The result may be shared with other callers through the cache, so it must not be modified
         '''
         if not start:
             start = self.get_default_date()
 
+        cache_key = (start, days, offset, full, menu_filter, fields)
+        version = get_data_version(self.db.session)
+
+        cached = self.cache.get(cache_key, version)
+        if cached is not None:
+            metrics.inc('menu_cache_requests_total', cache='fetch', result='hit')
+            return cached
+
+        metrics.inc('menu_cache_requests_total', cache='fetch', result='miss')
+        response = self.query_days(days, offset, start, full, menu_filter, fields)
+        self.cache.set(cache_key, response, version)
+        return response
+
+    def fetch_page_bounds(self, days: int, offset: int = 0,
+                          start: datetime.date = None) -> tuple:
+        '''
+        Returns the first and last dates with menu data in the window fetch_days would get with
+        the same arguments, or None if it's empty. Cursors to the neighbouring windows are made
+        from them
+        '''
+        if not start:
+            start = self.get_default_date()
+
+        cache_key = ('bounds', start, days, offset)
+        version = get_data_version(self.db.session)
+
+        bounds = self.cache.get(cache_key, version)
+        if bounds is not None:
+            metrics.inc('menu_cache_requests_total', cache='bounds', result='hit')
+            # Empty windows are cached as an empty tuple, as None means a miss
+            return bounds or None
+
+        metrics.inc('menu_cache_requests_total', cache='bounds', result='miss')
+        bounds = ()
+
         if offset != 0:
             start = self.fetch_valid_dates(1, offset, descending=bool(offset < 0), start=start)
-            if start:
-                start = start[0]
-            else:
-                return {}
+            start = start[0] if start else None
 
-        # Gets the end date by finding 1 valid day, with offset days - 1, which gives the next valid
-        # date, x days in advance
-        end = self.fetch_valid_dates(1, abs(days)-1, descending=bool(days < 0), start=start)
+        if start:
+            # The valid dates of the window, going backwards from the start for negative days
+            dates = self.fetch_valid_dates(abs(days), 0, descending=bool(days < 0), start=start)
+            if dates:
+                bounds = (min(dates), max(dates))
 
-        if end:
-            end = end[0]
-
-        if not end:
-            if days > 0:
-                # if a valid enddate is not found after the requested amount of days
-                # return everything after the start (which will be less than requested)
-                response = self.db.session.query(SageMenuItem).filter(
-                    SageMenuItem.c.date >= start).all()
-            else:
-                # do the same as above, but go IN REVERSE
-                response = self.db.session.query(SageMenuItem).filter(
-                    SageMenuItem.c.date <= start).all()
-        elif days > 0:
-            # query the db for all items between start and end dates
-            response = self.db.session.query(SageMenuItem).filter(
-                SageMenuItem.c.date.between(start, end)).all()
+        self.cache.set(cache_key, bounds, version)
+        return bounds or None
+
+    def query_days(self, days: int, offset: int, start: datetime.date, full: bool,
+                   menu_filter: MenuFilter = None, fields: tuple = None) -> dict:
+        '''
+        Does the actual db work for fetch_days, skipping the cache
+        '''
+        bounds = self.fetch_page_bounds(days, offset, start)
+        if not bounds:
+            return {}
+
+        if fields:
+            # Grouping needs its columns, even if they aren't asked for
+            columns = [column for field, column in COLUMNS_BY_FIELD.items()
+                       if field in fields or field in GROUPING_FIELDS]
         else:
-            # query the db for all items between "end" and "start" dates
-            response = self.db.session.query(SageMenuItem).filter(
-                SageMenuItem.c.date.between(end, start)).all()
+            columns = FULL_COLUMNS if full else DISPLAY_COLUMNS
+
+        query = self.db.session.query(*columns).select_from(SageMenuItem).join(
+            SageRecipe, SageRecipe.c.recipe_id == SageMenuItem.c.recipe_id)
+        if self.menu_id is not None:
+            query = query.filter(SageMenuItem.c.menu_id == self.menu_id)
+        if menu_filter:
+            query = menu_filter.apply(query, self.db.session)
+
+        # query the db for all items between the first and last dates of the window
+        query = query.filter(SageMenuItem.c.date.between(*bounds))
+
+        # Let SQLite do the sorting, so the rows can be grouped in a single pass
+        with metrics.timer('range_scan'):
+            response = query.order_by(*GROUPING_ORDER).all()
+        metrics.inc('menu_rows_fetched_total', len(response))
+
+        with metrics.timer('process_response'):
+            grouped_response = self.process_response(response)
+            if any(column.name == 'allergens' for column in columns):
+                self.format_allergens(grouped_response)
+            if fields:
+                self.project_fields(grouped_response, fields)
 
-        return self.process_response(response)
+        return grouped_response
+
+    @staticmethod
+    def project_fields(grouped_response: dict, fields: tuple):
+        '''
+        Drops every field but the given ones from each menu item in a process_response result,
+        in place
+        '''
+        for day in grouped_response.values():
+            for meal in day.values():
+                for station in meal.values():
+                    station[:] = [{field: item[field] for field in fields} for item in station]
+
+    @staticmethod
+    def format_allergens(grouped_response: dict):
+        '''
+        Turns the allergen ids of every menu item in a process_response result back into a
+        JSON list of allergens like Sage sends them, in place
+        '''
+        for day in grouped_response.values():
+            for meal in day.values():
+                for station in meal.values():
+                    for item in station:
+                        item['allergens'] = format_allergens(item['allergens'])
+
+    def export(self, start: datetime.date = None, end: datetime.date = None, after: tuple = None,
+               limit: int = None, menu_filter: MenuFilter = None, batch_size: int = 500):
+        '''
+        Yields every menu item between two dates as a dict with every field, like fetch_days with
+        full=True, in GROUPING_ORDER. Rows are read from the db batch_size at a time while
+        they're being yielded, so memory use doesn't grow with the amount of rows
+
+        start datetime.date: (optional) the first date to export, inclusive
+        end datetime.date: (optional) the last date to export, inclusive
+        after tuple: (optional) the (date, meal, station, id) of the last row already exported,
+            to carry on from where an earlier export stopped
+        limit int: (optional) the most rows to export
+        menu_filter: (optional) only export the menu items that pass these filters
+        batch_size: how many rows to read from the db at a time
+        '''
+        query = self.db.session.query(*FULL_COLUMNS).select_from(SageMenuItem).join(
+            SageRecipe, SageRecipe.c.recipe_id == SageMenuItem.c.recipe_id)
+        if self.menu_id is not None:
+            query = query.filter(SageMenuItem.c.menu_id == self.menu_id)
+        if start:
+            query = query.filter(SageMenuItem.c.date >= start)
+        if end:
+            query = query.filter(SageMenuItem.c.date <= end)
+        if after:
+            # The date check on its own lets SQLite skip straight to the right part of the index
+            query = query.filter(SageMenuItem.c.date >= after[0],
+                                 tuple_(*GROUPING_ORDER) > tuple_(*after))
+        if menu_filter:
+            query = menu_filter.apply(query, self.db.session)
+
+        query = query.order_by(*GROUPING_ORDER).limit(limit).yield_per(batch_size)
+
+        for row in query:
+            item = row._asdict()
+            item['allergens'] = format_allergens(item['allergens'])
+            yield item
 
     @staticmethod
     def process_response(response) -> dict:
-        # sort the responses by the date attribute so they can be sorted
-        response = sorted([i._asdict() for i in response], key=lambda k: k['date'])
+        '''
+        Groups menu items by day, then meal, then station in a single pass
 
-        # group the menu items by their date key
+        response: menu item rows, which must be ordered by GROUPING_ORDER
+
+        returns: dict, {'YYYY-MM-DD': {'meal': {'station': [menu_item, ...]}}}
+        '''
         grouped_response = {}
-        # Not using the group_by_key function because in this case, we need
-        # to turn the key from a datetime to a str when turning it into a dict.
-        for k, g in groupby(response, key=lambda k: k['date']):
-            grouped_response[k.strftime('%Y-%m-%d')] = list(g)
 
-        # iterate through each day of the grouped days
-        for key, value in grouped_response.items():
-            # for each day, group the menu items by meal
-            grouped_value = group_by_key(value, 'meal')
+        # As the rows come in sorted, a new bucket is only needed when a key changes
+        last_date = last_meal = last_station = None
+        day = meal = station = None
+
+        for row in response:
+            item = row._asdict()
+
+            if item['date'] != last_date:
+                last_date = item['date']
+                day = grouped_response[last_date.strftime('%Y-%m-%d')] = {}
+                last_meal = None
 
-            # iterate through the meals
-            for sub_key, sub_value in grouped_value.items():
-                # for each meal, group the menu items by station
-                grouped_value[sub_key] = group_by_key(sub_value, 'station')
+            if item['meal'] != last_meal:
+                last_meal = item['meal']
+                meal = day[str(last_meal)] = {}
+                last_station = None
 
-            grouped_response[key] = grouped_value
+            if item['station'] != last_station:
+                last_station = item['station']
+                station = meal[str(last_station)] = []
+
+            station.append(item)
 
         return grouped_response
 
-    def wordify(self) -> str:
+    def search(self, query: str, page: int = 1, per_page: int = 20) -> dict:
+        '''
+        Finds every time a menu item with words in its name starting with the words of the query
+        was served, newest first. Recipe names are matched with the FTS5 index, then their menu
+        items are found through the menu and recipe index, so it doesn't scan the menu history
+
+        query: the text to search for
+        page: which page of results to return, starting at 1
+        per_page: how many results are on a page
+
+        returns: dict, {'total': amount of results, 'results': [occurrence, ...]}
+        '''
+        match = build_match_query(query)
+        if not match:
+            return {'total': 0, 'results': []}
+
+        recipe_ids = select(RecipeSearch.c.rowid).where(RecipeSearch.c.name.match(match))
+
+        items = self.db.session.query(*OCCURRENCE_COLUMNS).select_from(SageMenuItem).join(
+            SageRecipe, SageRecipe.c.recipe_id == SageMenuItem.c.recipe_id).filter(
+                SageMenuItem.c.recipe_id.in_(recipe_ids))
+        if self.menu_id is not None:
+            items = items.filter(SageMenuItem.c.menu_id == self.menu_id)
+
+        total = items.count()
+        rows = items.order_by(SageMenuItem.c.date.desc(), *GROUPING_ORDER[1:]).limit(
+            per_page).offset((page - 1) * per_page).all()
+
+        return {'total': total, 'results': [format_occurrence(row) for row in rows]}
+
+    def fetch_changes(self, since: int) -> dict:
         '''
-        Gets the current menu data for today (or tomorrow if it's after lunch time) and makes it
-        human readable
+        Gets what changed in the menu since a data version, so clients can keep their own copy of
+        the menu in sync without downloading it again. Rows are lists in the order of their
+        columns, to keep it small
+
+        since: the version the client's copy is at, from the version of an earlier call. 0 for
+            everything
 
-        returns: str, A human readable representation of the menu
+        returns: dict, {'version': the current version, 'reset': True if the client has to throw
+            its copy away first, 'items': menu items that were added or changed, 'deleted': ids
+            of deleted menu items, 'recipes': the recipes of the items, and recipes that changed}
         '''
-        # Fetch menu data, and get the first item in the list, because we are requesting only one
-        # day's worth of data
-        date, menu_data = list(self.fetch_days(1).items())[0]
+        session = self.db.session
+        version = get_data_version(session)
 
-        date = datetime.strptime(date, '%Y-%m-%d')
+        # Changes from before the change log started aren't known, and versions from the future
+        # must be from a different db, so those clients start over with everything
+        reset = since <= 0 or since > version or since < get_change_log_start(session)
 
-        response = f'The menu for {date.strftime("%A, %B %d, %Y")}'
+        items = session.query(*CHANGE_ITEM_COLUMNS)
+        if self.menu_id is not None:
+            items = items.filter(SageMenuItem.c.menu_id == self.menu_id)
 
-        for meal, meal_value in menu_data.items():
-            response += f'\n\n{self.meal_titles[int(meal)]}'
-            for station, station_value in meal_value.items():
-                response += f'\n\n{STATION_TITLES[int(station)]}'
-                for menu_item in station_value:
-                    response += f'\n{menu_item["name"].replace("&amp;", "&")}'
+        deleted = []
+        if reset:
+            recipe_ids = items.with_entities(SageMenuItem.c.recipe_id)
+        else:
+            changes = session.query(SageChange.c.item_id).filter(SageChange.c.version > since)
+            if self.menu_id is not None:
+                changes = changes.filter(SageChange.c.menu_id == self.menu_id)
+
+            # Only the latest state of each item matters, so anything changed that's gone now
+            # was deleted, however many times it changed before that
+            items = items.filter(SageMenuItem.c.id.in_(changes))
+            deleted = [row[0] for row in changes.filter(SageChange.c.item_id.not_in(
+                session.query(SageMenuItem.c.id))).distinct().order_by(SageChange.c.item_id)]
+
+            # The client needs the recipes of changed items, which may be new to it, and recipes
+            # of its menu that changed
+            used_recipes = session.query(SageMenuItem.c.recipe_id)
+            if self.menu_id is not None:
+                used_recipes = used_recipes.filter(SageMenuItem.c.menu_id == self.menu_id)
+            recipe_ids = items.with_entities(SageMenuItem.c.recipe_id).union(
+                session.query(SageRecipeChange.c.recipe_id).filter(
+                    SageRecipeChange.c.version > since,
+                    SageRecipeChange.c.recipe_id.in_(used_recipes)))
+
+        items = items.order_by(SageMenuItem.c.id).all()
+        recipes = session.query(*CHANGE_RECIPE_COLUMNS).filter(
+            SageRecipe.c.recipe_id.in_(recipe_ids)).order_by(SageRecipe.c.recipe_id).all()
+        metrics.inc('menu_rows_fetched_total', len(items))
+
+        return {'version': version, 'reset': reset,
+                'items': {'columns': [column.name for column in CHANGE_ITEM_COLUMNS],
+                          'rows': [[format_change_value(column.name, value)
+                                    for column, value in zip(CHANGE_ITEM_COLUMNS, item)]
+                                   for item in items]},
+                'deleted': deleted,
+                'recipes': {'columns': [column.name for column in CHANGE_RECIPE_COLUMNS],
+                            # Allergens are just a list of Sage allergen ids here
+                            'rows': [[recipe_id, name, parse_allergen_ids(allergen_ids)]
+                                     for recipe_id, name, allergen_ids in recipes]}}
+
+    def next_occurrence(self, recipe_id: int, start: datetime.date = None) -> dict:
+        '''
+        Finds the next time a recipe is served, on or after start
 
-        return {"response": response}
+        recipe_id: the Sage recipe id
+        start datetime.date: (optional) uses the default date if not provided
 
+        returns: dict, the occurrence, or None if the recipe isn't on the menu again
+        '''
+        if not start:
+            start = self.get_default_date()
 
-def group_by_key(data: list, key: str) -> dict:
+        query = self.db.session.query(*OCCURRENCE_COLUMNS).select_from(SageMenuItem).join(
+            SageRecipe, SageRecipe.c.recipe_id == SageMenuItem.c.recipe_id).filter(
+                SageMenuItem.c.recipe_id == recipe_id, SageMenuItem.c.date >= start)
+        if self.menu_id is not None:
+            query = query.filter(SageMenuItem.c.menu_id == self.menu_id)
+
+        row = query.order_by(*GROUPING_ORDER).first()
+        return format_occurrence(row) if row else None
+
+    def wordify(self, day: datetime.date = None, locale: str = None) -> dict:
+        '''
+        Gets the spoken menu of a date. It's made when the date is scraped, so this is usually a
+        single lookup
+
+        day datetime.date: (optional) the date of the menu
+            - uses the first date with a menu from today (or tomorrow, if after 1pm) as default
+        locale str: (optional) one of wordify_locales, uses the first one as default
+
+        returns: dict, {'date': 'YYYY-MM-DD', 'response': the spoken menu, 'empty': True if
+            there's no menu that day}
+        '''
+        locale = locale or self.wordify_locales[0]
+
+        if not day:
+            dates = self.fetch_valid_dates(1, 0)
+            # If there's no menu coming up at all, say so about the default date
+            day = dates[0] if dates else self.get_default_date()
+
+        response = None
+        if self.menu_id is not None:
+            response = self.db.session.query(SageWordify.c.text).filter(
+                SageWordify.c.menu_id == self.menu_id, SageWordify.c.date == day,
+                SageWordify.c.locale == locale).scalar()
+
+        if response is not None:
+            return {'date': day.strftime('%Y-%m-%d'), 'response': response, 'empty': False}
+
+        # Not made yet, like for past dates or right after a scrape, so make it now
+        version = get_data_version(self.db.session)
+        menu_data = self.query_dates([day]).get(day.strftime('%Y-%m-%d'), {})
+        response = build_wordify_text(day, menu_data, self.meal_titles, locale)
+
+        # Days without a menu aren't stored, as any date can be asked for
+        if menu_data and not self.read_only:
+            self.save_wordify([(day, locale, response)], version)
+
+        return {'date': day.strftime('%Y-%m-%d'), 'response': response, 'empty': not menu_data}
+
+    def store_wordify(self):
+        '''
+        Makes and stores the spoken menu of every date from today on that doesn't have one, in
+        every locale. Meant to run once a scrape finishes
+        '''
+        if self.menu_id is None:
+            return
+
+        version = get_data_version(self.db.session)
+        today = datetime.now(self.timezone).date()
+
+        stored = set(self.db.session.query(SageWordify.c.date, SageWordify.c.locale).filter(
+            SageWordify.c.menu_id == self.menu_id, SageWordify.c.date >= today).all())
+        missing = [day for day, in self.db.session.query(ServedDate.c.date).filter(
+            ServedDate.c.menu_id == self.menu_id, ServedDate.c.date >= today).order_by(
+                ServedDate.c.date).all()
+                   if any((day, locale) not in stored for locale in self.wordify_locales)]
+
+        # A few weeks at a time, so a long menu doesn't have to fit in memory
+        for batch_start in range(0, len(missing), self.WORDIFY_BATCH_DAYS):
+            days = missing[batch_start:batch_start + self.WORDIFY_BATCH_DAYS]
+            menus = self.query_dates(days)
+
+            self.save_wordify([(day, locale, build_wordify_text(
+                day, menus.get(day.strftime('%Y-%m-%d'), {}), self.meal_titles, locale))
+                               for day in days for locale in self.wordify_locales
+                               if (day, locale) not in stored], version)
+
+    def save_wordify(self, spoken_menus: list, version: int):
+        '''
+        Stores spoken menus, unless the menu data changed since they were made, in which case
+        a scrape just cleared them out and they'd be stale
+
+        spoken_menus: a list of (date, locale, text)
+        version: the data version the menus were made from
+        '''
+        if not spoken_menus:
+            return
+
+        self.db.session.execute(text(
+            'INSERT OR REPLACE INTO sage_wordify (menu_id, date, locale, text) '
+            'SELECT :menu_id, :date, :locale, :text FROM data_version '
+            'WHERE id = 1 AND version = :version'),
+                                [{'menu_id': self.menu_id, 'date': day.strftime('%Y-%m-%d'),
+                                  'locale': locale, 'text': spoken_menu, 'version': version}
+                                 for day, locale, spoken_menu in spoken_menus])
+        self.db.session.commit()
+
+    def query_dates(self, dates: list) -> dict:
+        '''
+        Gets the menu items of some dates with the columns needed to display them, grouped like
+        fetch_days. Dates without a menu are left out
+        '''
+        query = self.db.session.query(*DISPLAY_COLUMNS).select_from(SageMenuItem).join(
+            SageRecipe, SageRecipe.c.recipe_id == SageMenuItem.c.recipe_id).filter(
+                SageMenuItem.c.date.in_(dates))
+        if self.menu_id is not None:
+            query = query.filter(SageMenuItem.c.menu_id == self.menu_id)
+
+        return self.process_response(query.order_by(*GROUPING_ORDER).all())
+
+def build_match_query(query: str) -> str:
+    '''
+    Turns search text into an FTS5 query matching names with words that start with every word
+    of the text. Each word is quoted, so FTS5 operators in the text are searched for as words
+    '''
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', query))
+
+def format_occurrence(row) -> dict:
     '''
-    Takes a list of dicts, groups the dicts into 'buckets' determined by a key in the dict,
-    then returns the bucket.
+    Turns a row of OCCURRENCE_COLUMNS into a dict, with the date in YYYY-MM-DD format
+    '''
+    occurrence = row._asdict()
+    occurrence['date'] = occurrence['date'].strftime('%Y-%m-%d')
+    return occurrence
 
-    data: list, A list of dicts
-    key: str, A key that every dict in data must have, sorts by this key
+def parse_allergen_ids(allergen_ids: str) -> list:
+    '''
+    Turns the allergen_ids column of a recipe into a list of Sage allergen ids, in Sage's order
     '''
-    # Sort the data for the groupby function
-    sorted_data = sorted(data, key=lambda k: k[key])
+    return [int(allergen_id) for allergen_id in allergen_ids.split(',') if allergen_id]
 
-    grouped_data = {}
-    # iterate through the groupby iterator, and add to a dictionary
-    for k, g in groupby(sorted_data, key=lambda k: k[key]):
-        grouped_data[str(k)] = list(g)
+def format_allergens(allergen_ids: str) -> str:
+    '''
+    Turns the allergen_ids column of a recipe into a JSON list of allergens, like Sage sends them
+    '''
+    return json.dumps([{'id': str(allergen_id)}
+                       for allergen_id in parse_allergen_ids(allergen_ids)])
 
-    return grouped_data
+def format_change_value(column_name: str, value):
+    '''
+    Formats a menu item value for /changes. Dates are ISO strings, and misc properties are
+    parsed, so they aren't JSON inside JSON
+    '''
+    if column_name == 'date':
+        return value.isoformat()
+    if column_name == 'misc':
+        return json.loads(value) if value else None
+    return value
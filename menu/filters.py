@@ -0,0 +1,163 @@
+from dataclasses import dataclass
+from sqlalchemy import or_
+from sqlalchemy.orm import Query, Session
+from menu.models import SageAllergen, SageMenuItem, SageRecipe
+from menu.scrapers.sage import DOT_TO_COLORS, STATION_TITLES
+
+# Every field a menu item has in /fetch, in the order they're listed
+ITEM_FIELDS = tuple(column.name for column in SageMenuItem.c if column.name != 'misc') + (
+    'name', 'allergens', 'misc')
+
+# Every dot colour, in the order they show up in DOT_TO_COLORS
+DOT_COLORS = tuple(dict.fromkeys(color for colors in DOT_TO_COLORS.values() for color in colors))
+
+@dataclass(frozen=True)
+class MenuFilter:
+    '''
+    A data class of filters for menu items, which are applied in SQL by Fetcher.fetch_days.
+    An empty filter lets every item through. It's hashable, so it can be part of a cache key
+
+    meals tuple: meal numbers to keep
+    stations tuple: station numbers to keep
+    colors tuple: dot colours, items need at least one of them
+    exclude_colors tuple: dot colours, items can't have any of them
+    exclude_allergens tuple: Sage allergen ids, items can't contain any of them
+    search str: text the item's name has to contain, ignoring case
+    '''
+    meals: tuple = ()
+    stations: tuple = ()
+    colors: tuple = ()
+    exclude_colors: tuple = ()
+    exclude_allergens: tuple = ()
+    search: str = None
+
+    def __bool__(self) -> bool:
+        return any((self.meals, self.stations, self.colors, self.exclude_colors,
+                    self.exclude_allergens, self.search))
+
+    def apply(self, query: Query, session: Session) -> Query:
+        '''
+        Adds the filters to a query of menu items joined with their recipes
+
+        query: the query to filter
+        session: the db session, used to look up allergen bits
+        '''
+        if self.meals:
+            query = query.filter(SageMenuItem.c.meal.in_(self.meals))
+
+        if self.stations:
+            query = query.filter(SageMenuItem.c.station.in_(self.stations))
+
+        if self.colors:
+            query = query.filter(SageMenuItem.c.dot.in_(dots_with_colors(self.colors)))
+
+        if self.exclude_colors:
+            # Items without a dot don't have any colour, so they stay
+            query = query.filter(or_(SageMenuItem.c.dot.is_(None),
+                                     SageMenuItem.c.dot.notin_(
+                                         dots_with_colors(self.exclude_colors))))
+
+        if self.exclude_allergens:
+            # Allergens are stored as a bitmask, so excluding several is a single check
+            bits = session.query(SageAllergen.c.bit).filter(
+                SageAllergen.c.id.in_(self.exclude_allergens)).all()
+            mask = sum(1 << bit for bit, in bits)
+            # An allergen that's never been scraped can't be in any item
+            if mask:
+                query = query.filter(SageRecipe.c.allergens.op('&')(mask) == 0)
+
+        if self.search:
+            # SQLite's LIKE ignores case for ascii letters
+            query = query.filter(SageRecipe.c.name.contains(self.search, autoescape=True))
+
+        return query
+
+
+def dots_with_colors(colors: tuple) -> list:
+    '''
+    Returns every dot number that has at least one of the colours
+    '''
+    return [dot for dot, dot_colors in DOT_TO_COLORS.items()
+            if any(color in dot_colors for color in colors)]
+
+def split_arg(args, name: str) -> list:
+    '''
+    Gets a query arg as a list, which can be given either comma separated or repeated,
+    like ?meal=1,2 or ?meal=1&meal=2
+    '''
+    return [value.strip() for arg in args.getlist(name) for value in arg.split(',')
+            if value.strip()]
+
+def parse_numbers_or_titles(values: list, titles: list, name: str) -> tuple:
+    '''
+    Turns a list of numbers or titles (ignoring case) into a sorted tuple of numbers
+    '''
+    lower_titles = [title.lower() if title else None for title in titles]
+    numbers = set()
+
+    for value in values:
+        if value.isdigit():
+            numbers.add(int(value))
+        elif value.lower() in lower_titles:
+            numbers.add(lower_titles.index(value.lower()))
+        else:
+            raise MenuFilterError(f'Unknown {name} "{value}"')
+
+    return tuple(sorted(numbers))
+
+def parse_colors(values: list) -> tuple:
+    '''
+    Turns a list of dot colours (ignoring case) into a sorted tuple of colours
+    '''
+    colors = {value.lower() for value in values}
+    for color in colors:
+        if color not in DOT_COLORS:
+            raise MenuFilterError(f'Unknown dot colour "{color}", try one of '
+                                  f'{", ".join(DOT_COLORS)}')
+
+    return tuple(sorted(colors))
+
+def parse_menu_filter(args, meal_titles: list) -> MenuFilter:
+    '''
+    Builds a MenuFilter from the query args of a request
+
+    args: the request's query args
+    meal_titles: the tenant's meal titles, so meals can be filtered by name
+
+    raises MenuFilterError if an arg doesn't make sense
+    '''
+    allergens = split_arg(args, 'exclude_allergen')
+    for allergen in allergens:
+        if not allergen.isdigit():
+            raise MenuFilterError(f'Allergen ids are numbers, not "{allergen}"')
+
+    return MenuFilter(meals=parse_numbers_or_titles(split_arg(args, 'meal'), meal_titles, 'meal'),
+                      stations=parse_numbers_or_titles(split_arg(args, 'station'),
+                                                       STATION_TITLES, 'station'),
+                      colors=parse_colors(split_arg(args, 'dot')),
+                      exclude_colors=parse_colors(split_arg(args, 'exclude_dot')),
+                      exclude_allergens=tuple(sorted({int(allergen) for allergen in allergens})),
+                      search=args.get('q', '').strip() or None)
+
+def parse_fields(args) -> tuple:
+    '''
+    Gets the fields=... projection of a request as a tuple in ITEM_FIELDS order,
+    or None if every field was asked for
+
+    raises MenuFilterError if a field doesn't exist
+    '''
+    fields = split_arg(args, 'fields')
+    if not fields:
+        return None
+
+    for field in fields:
+        if field not in ITEM_FIELDS:
+            raise MenuFilterError(f'Unknown field "{field}", try one of {", ".join(ITEM_FIELDS)}')
+
+    return tuple(field for field in ITEM_FIELDS if field in fields)
+
+
+class MenuFilterError(BaseException):
+    '''
+    An exception to be used when a request's menu filters don't make sense
+    '''
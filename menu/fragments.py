@@ -0,0 +1,37 @@
+from datetime import datetime
+from flask import render_template
+from markupsafe import Markup
+from menu.cache import LRUCache
+from menu.metrics import metrics
+
+def render_days(cache: LRUCache, version: int, key: tuple, menu_data: dict, **context) -> list:
+    '''
+    Renders each day of a fetch_days result as HTML with templates/day.html. Days are cached by
+    date and data version, so neighbouring pages, which share most of their days, and the 1pm
+    switch to the next day only render the days that weren't on screen before
+
+    cache: the LRUCache to keep rendered days in
+    version: the data version menu_data was fetched at
+    key: a tuple of anything else a day's HTML depends on, like the tenant
+    menu_data: a fetch_days result
+    context: the rest of the template variables, like titles and DOT_TO_COLORS
+
+    returns: a list of each day's HTML, in order
+    '''
+    days = []
+    for day, meals in menu_data.items():
+        cache_key = key + (day,)
+
+        rendered = cache.get(cache_key, version)
+        if rendered is None:
+            metrics.inc('menu_cache_requests_total', cache='fragment', result='miss')
+            heading = datetime.strptime(day, '%Y-%m-%d').strftime('%A, %B %d, %Y')
+            rendered = Markup(render_template('day.html', heading=heading, menu_data=meals,
+                                              **context))
+            cache.set(cache_key, rendered, version)
+        else:
+            metrics.inc('menu_cache_requests_total', cache='fragment', result='hit')
+
+        days.append(rendered)
+
+    return days
@@ -0,0 +1,187 @@
+import json
+import time
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from uuid import uuid4
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import exists, literal, select
+from menu.models import ScrapeJob
+
+class ScrapeQueue:
+    '''
+    Runs scrapes on a background thread, one at a time across every worker sharing the db.
+
+    Jobs live in the scrape_job table, so any worker can report on any job, and a trigger that
+    comes in while a job is still waiting to start is merged into that job
+    '''
+    # How long a running job can go without reporting progress before it's assumed dead
+    STALE_AFTER = timedelta(minutes=30)
+    # How long to wait before checking again if another worker is scraping
+    POLL_INTERVAL = 5
+    # How long finished jobs are kept around for
+    KEEP_FOR = timedelta(days=7)
+
+    def __init__(self, app: Flask, db: SQLAlchemy, run):
+        '''
+        app: the Flask app, jobs are run inside its app context
+        db: SQLAlchemy Instance holding the scrape_job table
+        run: a function that accepts a job id, runs the scrape, and returns the amount of
+            menu items saved. It can report progress with report_progress, from any thread
+            with an app context
+        '''
+        self.app = app
+        self.db = db
+        self.run = run
+
+        self.wakeup = Event()
+        self.thread = None
+        self.thread_lock = Lock()
+        # Menus are scraped in parallel, so progress reports can't overlap
+        self.progress_lock = Lock()
+
+    def submit(self) -> str:
+        '''
+        Queues a scrape, unless one is already waiting to start, and returns the job id
+        '''
+        now = datetime.utcnow()
+
+        # Only insert a job if none is queued, in one statement so two workers can't both insert
+        new_job = select(literal(uuid4().hex), literal('queued'), literal(now),
+                         literal(now)).where(~exists().where(ScrapeJob.c.status == 'queued'))
+        self.db.session.execute(ScrapeJob.insert().from_select(
+            ['id', 'status', 'created_at', 'updated_at'], new_job))
+
+        job_id = self.db.session.query(ScrapeJob.c.id).filter(
+            ScrapeJob.c.status == 'queued').order_by(ScrapeJob.c.created_at).limit(1).scalar()
+        self.db.session.commit()
+
+        self.start_thread()
+        self.wakeup.set()
+
+        return job_id
+
+    def get(self, job_id: str) -> dict:
+        '''
+        Returns the status of a job as a dict, or None if there's no such job
+        '''
+        job = self.db.session.query(ScrapeJob).filter(ScrapeJob.c.id == job_id).first()
+        if not job:
+            return None
+
+        job = job._asdict()
+        job['progress'] = json.loads(job['progress']) if job['progress'] else {}
+
+        # The duration so far for running jobs, or the whole duration for finished ones
+        if job['started_at']:
+            end = job['finished_at'] or datetime.utcnow()
+            job['duration'] = (end - job['started_at']).total_seconds()
+        else:
+            job['duration'] = None
+
+        for key in ('created_at', 'started_at', 'updated_at', 'finished_at'):
+            if job[key]:
+                job[key] = job[key].isoformat() + 'Z'
+
+        return job
+
+    def wait(self, job_id: str, poll_interval: float = 1) -> dict:
+        '''
+        Waits for a job to finish or fail, and returns its status
+        '''
+        while True:
+            job = self.get(job_id)
+            # End the read transaction, so the next check sees the worker's updates
+            self.db.session.commit()
+            if not job or job['status'] in ('finished', 'failed'):
+                return job
+            time.sleep(poll_interval)
+
+    def report_progress(self, job_id: str, menu: str, week: int, rows: int):
+        '''
+        Records that a week of a job is done
+
+        job_id: the job being run
+        menu: the name of the menu the week belongs to
+        week: the week that was fetched
+        rows: the amount of menu items fetched for that week
+        '''
+        with self.progress_lock:
+            progress = self.db.session.query(ScrapeJob.c.progress).filter(
+                ScrapeJob.c.id == job_id).scalar()
+            progress = json.loads(progress) if progress else {}
+            progress.setdefault(menu, {})[str(week)] = rows
+
+            self.update(job_id, progress=json.dumps(progress))
+
+    def update(self, job_id: str, **values):
+        values['updated_at'] = datetime.utcnow()
+        self.db.session.execute(ScrapeJob.update().where(ScrapeJob.c.id == job_id).values(**values))
+        self.db.session.commit()
+
+    def start_thread(self):
+        # The worker thread is only started once a job is submitted, so read only workers never
+        # have one
+        with self.thread_lock:
+            if not self.thread:
+                self.thread = Thread(target=self.work, name='scrape-queue', daemon=True)
+                self.thread.start()
+
+    def work(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+
+            with self.app.app_context():
+                while self.run_next():
+                    pass
+
+    def run_next(self) -> bool:
+        '''
+        Runs the oldest queued job if no other scrape is running
+
+        returns: True if there may be more work to do, False if the queue is empty
+        '''
+        job_id = self.db.session.query(ScrapeJob.c.id).filter(
+            ScrapeJob.c.status == 'queued').order_by(ScrapeJob.c.created_at).limit(1).scalar()
+        if not job_id:
+            self.db.session.commit()
+            return False
+
+        now = datetime.utcnow()
+        # Jobs that stopped reporting progress belong to a worker that died, so give up on them
+        self.db.session.execute(ScrapeJob.update().where(ScrapeJob.c.status == 'running').where(
+            ScrapeJob.c.updated_at <= now - self.STALE_AFTER).values(
+                status='failed', finished_at=now, error='Stopped reporting progress'))
+
+        # Claim the job, only if no other scrape is running, in one statement so that
+        # workers can't both claim a job at the same time
+        running = exists().where(ScrapeJob.c.status == 'running').where(
+            ScrapeJob.c.updated_at > now - self.STALE_AFTER)
+        claimed = self.db.session.execute(ScrapeJob.update().where(
+            ScrapeJob.c.id == job_id).where(ScrapeJob.c.status == 'queued').where(
+                ~running).values(status='running', started_at=now, updated_at=now))
+        self.db.session.commit()
+
+        if not claimed.rowcount:
+            # Someone else is scraping (or just took this job), so check back in a bit
+            self.wakeup.wait(self.POLL_INTERVAL)
+            return True
+
+        try:
+            rows = self.run(job_id)
+        #pylint: disable=broad-except
+        except BaseException as error:
+            self.db.session.rollback()
+            self.app.logger.exception('Scrape job %s failed', job_id)
+            self.update(job_id, status='failed', finished_at=datetime.utcnow(),
+                        error=repr(error))
+        else:
+            self.update(job_id, status='finished', finished_at=datetime.utcnow(), rows=rows)
+
+        # Clear out old jobs, so the table doesn't grow forever
+        self.db.session.execute(ScrapeJob.delete().where(
+            ScrapeJob.c.finished_at < datetime.utcnow() - self.KEEP_FOR))
+        self.db.session.commit()
+
+        return True
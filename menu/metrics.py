@@ -0,0 +1,151 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+import time
+
+# The upper bounds of histogram buckets, in seconds, the same as the Prometheus client defaults
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# The type and help text of every metric, in the order they're exported
+METRICS = {
+    'menu_stage_duration_seconds': ('histogram', 'Time spent in each stage of serving or '
+                                                 'scraping the menu'),
+    'menu_rows_fetched_total': ('counter', 'Menu items read from the db'),
+    'menu_cache_requests_total': ('counter', 'Cache lookups, by cache and whether they hit'),
+    'http_request_duration_seconds': ('histogram', 'Time spent answering requests, by endpoint '
+                                                   'and status'),
+    'sage_request_duration_seconds': ('histogram', 'Time spent on Sage API requests, by resource '
+                                                   'and status'),
+    'sage_weeks_scraped_total': ('counter', 'Weeks of menu data fetched from Sage, by menu'),
+    'sage_rows_scraped_total': ('counter', 'Menu items fetched from Sage, by menu'),
+}
+
+# The stage timings of the request being answered, as a dict of stage to milliseconds, or None
+# if Server-Timing headers are off. Each request runs in its own context, so they don't mix
+server_timings = ContextVar('server_timings', default=None)
+
+
+class Metrics:
+    '''
+    A thread safe registry of counters and histograms, exported in the Prometheus text format.
+    Every process has its own, so each worker has to be scraped separately
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        # (name, labels) to a number for counters,
+        # or to [bucket counts, count, sum] for histograms
+        self.values = {}
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        '''
+        Adds amount to a counter
+
+        name: the name of the metric, from METRICS
+        labels: the labels of the series to add to
+        '''
+        key = series_key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        '''
+        Records a duration in a histogram
+
+        name: the name of the metric, from METRICS
+        seconds: the duration to record
+        labels: the labels of the series to record it in
+        '''
+        key = series_key(name, labels)
+        bucket = bisect_left(BUCKETS, seconds)
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [[0] * len(BUCKETS), 0, 0.0]
+            if bucket < len(BUCKETS):
+                histogram[0][bucket] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    @contextmanager
+    def timer(self, stage: str):
+        '''
+        Times the code in a with block as a stage, and adds it to the Server-Timing header of
+        the current request, if there is one
+
+        stage: the name of the stage, like fetch_valid_dates
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe('menu_stage_duration_seconds', seconds, stage=stage)
+
+            timings = server_timings.get()
+            if timings is not None:
+                # A stage that runs more than once in a request reports its total
+                timings[stage] = timings.get(stage, 0) + seconds * 1000
+
+    def render(self) -> str:
+        '''
+        Returns every metric in the Prometheus text format
+        '''
+        with self.lock:
+            values = sorted((key, value if isinstance(value, (int, float)) else
+                             [list(value[0]), value[1], value[2]])
+                            for key, value in self.values.items())
+
+        lines = []
+        for name, (metric_type, description) in METRICS.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric_type}')
+
+            for (series_name, labels), value in values:
+                if series_name != name:
+                    continue
+
+                if metric_type == 'counter':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+
+                # Histogram buckets are cumulative
+                buckets, count, total = value
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS, buckets):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} '
+                                 f'{cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {total}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def series_key(name: str, labels: dict) -> tuple:
+    '''
+    Returns the key of a series in Metrics.values. Label values are kept as strings, so series
+    can be sorted even when a label is None, like the endpoint of a request no route matched
+    '''
+    return (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+
+def format_labels(labels: tuple) -> str:
+    '''
+    Formats (name, value) label pairs like {name="value"}, escaping values like Prometheus does
+    '''
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')) for name, value in labels) + '}'
+
+def format_server_timing(timings: dict) -> str:
+    '''
+    Formats a dict of stage to milliseconds as a Server-Timing header
+    '''
+    return ', '.join(f'{stage};dur={milliseconds:.2f}' for stage, milliseconds in timings.items())
+
+
+#pylint: disable=invalid-name
+metrics = Metrics()
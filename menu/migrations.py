@@ -0,0 +1,154 @@
+import html
+import json
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text
+from menu.models import RECIPE_SEARCH_DDL
+
+# Schema changes for dbs created by older versions, run in order. The position of a migration
+# in the list (starting at 1) is the schema version it upgrades to, stored in PRAGMA user_version.
+# Migrations use plain SQL, as the models describe the latest schema, not the one being upgraded
+MIGRATIONS = []
+
+
+def migration(func):
+    '''
+    Decorator that adds a function to the list of migrations
+    '''
+    MIGRATIONS.append(func)
+    return func
+
+
+@migration
+def add_menu_item_index_and_served_dates(connection):
+    # served_date is created by create_all, but it has to be filled in from existing menu items
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_sage_menu_item_date_meal_station_card '
+                            'ON sage_menu_item (date, meal, station, card)'))
+    connection.execute(text('INSERT OR IGNORE INTO served_date (menu_id, date) '
+                            'SELECT DISTINCT menu_id, date FROM sage_menu_item'))
+
+
+@migration
+def scope_menu_item_index_by_menu(connection):
+    # Fetchers only read one menu, so the menu id leads the index now
+    connection.execute(text('DROP INDEX IF EXISTS ix_sage_menu_item_date_meal_station_card'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS '
+                            'ix_sage_menu_item_menu_date_meal_station_card '
+                            'ON sage_menu_item (menu_id, date, meal, station, card)'))
+
+
+@migration
+def normalize_recipes_and_allergens(connection):
+    # Recipe names and allergens move from every menu item into sage_recipe, with allergens as a
+    # bitmask and as ids in Sage's order. Misc properties can differ between servings, so they
+    # stay on menu items. sage_recipe and sage_allergen are created by create_all
+    bits = {}
+    recipes = {}
+    for recipe_id, name, allergens in connection.execute(text(
+            'SELECT recipe_id, name, allergens FROM sage_menu_item ORDER BY id')):
+        allergen_ids = [int(allergen['id']) for allergen in json.loads(allergens or '[]')]
+        mask = 0
+        for allergen_id in allergen_ids:
+            bit = bits.setdefault(allergen_id, len(bits))
+            mask |= 1 << bit
+        # Later menu items win, like they would when scraping
+        recipes[recipe_id] = {'recipe_id': recipe_id, 'name': name, 'allergens': mask,
+                              'allergen_ids': ','.join(str(allergen_id)
+                                                       for allergen_id in allergen_ids)}
+
+    if len(bits) > 63:
+        raise ValueError('More than 63 allergens can\'t fit in a bitmask')
+
+    if bits:
+        connection.execute(text('INSERT OR IGNORE INTO sage_allergen (id, bit) VALUES (:id, :bit)'),
+                           [{'id': allergen_id, 'bit': bit} for allergen_id, bit in bits.items()])
+    if recipes:
+        connection.execute(text('INSERT OR REPLACE INTO sage_recipe (recipe_id, name, allergens, '
+                                'allergen_ids) VALUES (:recipe_id, :name, :allergens, '
+                                ':allergen_ids)'),
+                           list(recipes.values()))
+
+    # SQLite can't drop columns everywhere, so the menu item table is rebuilt without them
+    connection.execute(text('ALTER TABLE sage_menu_item RENAME TO sage_menu_item_old'))
+    connection.execute(text(
+        'CREATE TABLE sage_menu_item (id INTEGER NOT NULL, menu_id INTEGER NOT NULL, '
+        'recipe_id INTEGER NOT NULL, day INTEGER NOT NULL, week INTEGER NOT NULL, '
+        'meal INTEGER NOT NULL, card INTEGER, dot INTEGER, station INTEGER NOT NULL, '
+        'date DATE NOT NULL, misc TEXT, PRIMARY KEY (id))'))
+    connection.execute(text(
+        'INSERT INTO sage_menu_item (id, menu_id, recipe_id, day, week, meal, card, dot, '
+        'station, date, misc) SELECT id, menu_id, recipe_id, day, week, meal, card, dot, '
+        'station, date, misc FROM sage_menu_item_old'))
+    connection.execute(text('DROP TABLE sage_menu_item_old'))
+    connection.execute(text('CREATE INDEX ix_sage_menu_item_menu_date_meal_station_card '
+                            'ON sage_menu_item (menu_id, date, meal, station, card)'))
+
+    # Staging only holds data mid scrape, so it can just be recreated
+    connection.execute(text('DROP TABLE IF EXISTS sage_menu_item_staging'))
+    connection.execute(text(
+        'CREATE TABLE sage_menu_item_staging (id INTEGER NOT NULL, menu_id INTEGER NOT NULL, '
+        'recipe_id INTEGER NOT NULL, day INTEGER NOT NULL, week INTEGER NOT NULL, '
+        'meal INTEGER NOT NULL, card INTEGER, dot INTEGER, station INTEGER NOT NULL, '
+        'date DATE NOT NULL, misc TEXT, name TEXT NOT NULL, allergens INTEGER NOT NULL, '
+        'allergen_ids TEXT NOT NULL, PRIMARY KEY (id))'))
+
+
+@migration
+def add_recipe_search(connection):
+    # The full text index of recipe names, and an index to find every time a recipe was served
+    connection.execute(text(RECIPE_SEARCH_DDL))
+    connection.execute(text('DELETE FROM sage_recipe_search'))
+    connection.execute(text('INSERT INTO sage_recipe_search (rowid, name) '
+                            'SELECT recipe_id, name FROM sage_recipe'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_sage_menu_item_menu_recipe_date '
+                            'ON sage_menu_item (menu_id, recipe_id, date)'))
+
+
+@migration
+def unescape_recipe_names(connection):
+    # Names are html unescaped when they're scraped now, so older ones catch up here.
+    # sage_wordify is created by create_all, and filled in as dates are asked for
+    names = [{'recipe_id': recipe_id, 'name': html.unescape(name)}
+             for recipe_id, name in connection.execute(text(
+                 "SELECT recipe_id, name FROM sage_recipe WHERE name LIKE '%&%'"))
+             if html.unescape(name) != name]
+
+    if names:
+        connection.execute(text('UPDATE sage_recipe SET name = :name '
+                                'WHERE recipe_id = :recipe_id'), names)
+        connection.execute(text('UPDATE sage_recipe_search SET name = :name '
+                                'WHERE rowid = :recipe_id'), names)
+
+
+@migration
+def start_change_log(connection):
+    # sage_change and sage_recipe_change are created by create_all, but nothing that changed
+    # before now is in them, so /changes has to know where they start
+    columns = [row[1] for row in connection.execute(text('PRAGMA table_info(data_version)'))]
+    # data_version is new too in dbs from before it, and create_all already gave it the column
+    if 'change_log_start' not in columns:
+        connection.execute(text('ALTER TABLE data_version ADD COLUMN change_log_start INTEGER'))
+    connection.execute(text('UPDATE data_version SET change_log_start = version'))
+
+
+def upgrade(db: SQLAlchemy):
+    '''
+    Creates any missing tables, then runs every migration the db hasn't had yet.
+    A brand new db already has the latest schema, so it's marked as up to date instead
+
+    db: SQLAlchemy Instance, must be called inside an app context
+    '''
+    fresh = not inspect(db.engine).has_table('sage_menu_item')
+
+    db.create_all()
+
+    with db.engine.begin() as connection:
+        if fresh:
+            version = len(MIGRATIONS)
+        else:
+            version = connection.execute(text('PRAGMA user_version')).scalar()
+            for func in MIGRATIONS[version:]:
+                func(connection)
+            version = len(MIGRATIONS)
+
+        # PRAGMA doesn't accept bound parameters, but version is always an int
+        connection.execute(text(f'PRAGMA user_version = {int(version)}'))
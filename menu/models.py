@@ -1,23 +1,298 @@
+import os
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, column, event, exists, select, table, text
 
 #pylint: disable=invalid-name
 db = SQLAlchemy()
 
+def menu_item_columns() -> list:
+    '''
+    Returns new copies of the menu item columns, as a column can only belong to one table
+    '''
+    return [db.Column('id', db.Integer, primary_key=True),
+            db.Column('menu_id', db.Integer, nullable=False),
+            db.Column('recipe_id', db.Integer, nullable=False),
+            db.Column('day', db.Integer, nullable=False),
+            db.Column('week', db.Integer, nullable=False),
+            db.Column('meal', db.Integer, nullable=False),
+            db.Column('card', db.Integer, nullable=True),
+            db.Column('dot', db.Integer, nullable=True),
+            db.Column('station', db.Integer, nullable=False),
+            db.Column('date', db.Date, nullable=False),
+            # A JSON dict of the rest of the other misc properties that aren't
+            # planned to be used soon. Keeping them around in case they become useful.
+            # They can change between servings of a recipe, like price and featured
+            db.Column('misc', db.Text)]
+
+
+def recipe_columns() -> list:
+    '''
+    Returns new copies of the recipe level columns, everything but the recipe id
+    '''
+    return [db.Column('name', db.Text, nullable=False),
+            # A bitmask of allergens, each bit is one allergen in the sage_allergen table
+            db.Column('allergens', db.Integer, nullable=False, default=0),
+            # The same allergens as comma separated Sage allergen ids, in the order Sage lists
+            # them, which the bitmask can't keep
+            db.Column('allergen_ids', db.Text, nullable=False, default='')]
+
+
 SageMenuItem = db.Table('sage_menu_item',
+                        *menu_item_columns(),
+                        # Covers the date range scans of a menu in Fetcher, in the order
+                        # items are grouped
+                        db.Index('ix_sage_menu_item_menu_date_meal_station_card',
+                                 'menu_id', 'date', 'meal', 'station', 'card'),
+                        # Finds every time a recipe was served, for search and next occurrences
+                        db.Index('ix_sage_menu_item_menu_recipe_date',
+                                 'menu_id', 'recipe_id', 'date')
+                        )
+
+# The same recipes come back every menu cycle, so their names and allergens are only stored once
+SageRecipe = db.Table('sage_recipe',
+                      db.Column('recipe_id', db.Integer, primary_key=True),
+                      *recipe_columns()
+                      )
+
+# An SQLite FTS5 index of recipe names, with the recipe id as its rowid. It's a virtual table,
+# so it's created by the DDL below instead of create_all, and only described here for queries.
+# Kept in sync with sage_recipe by SageScraper.swap through sync_recipe_search
+RecipeSearch = table('sage_recipe_search', column('rowid'), column('name'))
+
+RECIPE_SEARCH_DDL = ('CREATE VIRTUAL TABLE IF NOT EXISTS sage_recipe_search USING fts5('
+                     'name, tokenize = "unicode61 remove_diacritics 2", prefix = \'2 3\')')
+
+event.listen(SageRecipe, 'after_create', DDL(RECIPE_SEARCH_DDL))
+
+# Maps Sage allergen ids to the bit they use in allergen bitmasks
+SageAllergen = db.Table('sage_allergen',
                         db.Column('id', db.Integer, primary_key=True),
-                        db.Column('menu_id', db.Integer, nullable=False),
-                        db.Column('recipe_id', db.Integer, nullable=False),
-                        db.Column('day', db.Integer, nullable=False),
-                        db.Column('week', db.Integer, nullable=False),
-                        db.Column('meal', db.Integer, nullable=False),
-                        db.Column('card', db.Integer, nullable=True),
-                        db.Column('dot', db.Integer, nullable=True),
-                        db.Column('station', db.Integer, nullable=False),
-                        db.Column('name', db.Text, nullable=False),
-                        # Allergens is a JSON list of allergen data
-                        db.Column('allergens', db.Text),
-                        db.Column('date', db.Date, nullable=False),
-                        # A JSON dict of the rest of the other misc properties that aren't
-                        # planned to be used soon. Keeping them around in case they become useful
-                        db.Column('misc', db.Text)
+                        db.Column('bit', db.Integer, nullable=False, unique=True)
+                        )
+
+# Menu items are streamed in here while a scrape runs, then swapped into sage_menu_item
+# and sage_recipe all at once, so readers never see a partially replaced menu
+SageMenuItemStaging = db.Table('sage_menu_item_staging', *menu_item_columns(),
+                               *recipe_columns())
+
+# Every date with menu data, kept up to date by SageScraper.save, so finding the next x dates
+# with menu data is an index seek instead of a DISTINCT over every menu item
+ServedDate = db.Table('served_date',
+                      db.Column('menu_id', db.Integer, primary_key=True),
+                      db.Column('date', db.Date, primary_key=True),
+                      db.Index('ix_served_date_date', 'date')
+                      )
+
+# The spoken menu of each date in each locale, made when the date is scraped, so /wordify is a
+# single lookup
+SageWordify = db.Table('sage_wordify',
+                       db.Column('menu_id', db.Integer, primary_key=True),
+                       db.Column('date', db.Date, primary_key=True),
+                       db.Column('locale', db.Text, primary_key=True),
+                       db.Column('text', db.Text, nullable=False)
+                       )
+
+# The newLastUpdate watermark Sage last reported for each menu, used by incremental scrapes
+SageMenuState = db.Table('sage_menu_state',
+                         db.Column('menu_id', db.Integer, primary_key=True),
+                         db.Column('last_update', db.Text, nullable=False)
+                         )
+
+# A hash of each week's raw getmenuitems payload, so incremental scrapes can skip unchanged weeks
+SageWeekHash = db.Table('sage_week_hash',
+                        db.Column('menu_id', db.Integer, primary_key=True),
+                        db.Column('week', db.Integer, primary_key=True),
+                        db.Column('hash', db.Text, nullable=False)
                         )
+
+# The length and first date of each menu's cycle as Sage last reported them, so the current week
+# can be worked out without asking Sage
+SageMenuCycle = db.Table('sage_menu_cycle',
+                         db.Column('menu_id', db.Integer, primary_key=True),
+                         db.Column('cycle_length', db.Integer, nullable=False),
+                         # menuFirstDate as Sage sends it, like 08/18/2019
+                         db.Column('first_date', db.Text, nullable=False)
+                         )
+
+# The last access token of each Sage account and when it expires (in UTC), so restarts and other
+# processes can reuse it instead of logging in again
+SageToken = db.Table('sage_token',
+                     db.Column('email', db.Text, primary_key=True),
+                     db.Column('access_token', db.Text, nullable=False),
+                     db.Column('expires_at', db.DateTime, nullable=False)
+                     )
+
+# A single row holding a counter that goes up every time menu data is saved, shared by every
+# worker using the db, so in-process caches know when they're stale
+DataVersion = db.Table('data_version',
+                       db.Column('id', db.Integer, primary_key=True),
+                       db.Column('version', db.Integer, nullable=False),
+                       db.Column('updated_at', db.DateTime, nullable=False),
+                       # The version the change log starts at, as dbs from before it have
+                       # changes it doesn't know about. Empty for dbs that always had it
+                       db.Column('change_log_start', db.Integer)
+                       )
+
+# Every menu item a save inserted, updated or deleted, under the data version it made, so
+# clients can sync just what changed through /changes
+SageChange = db.Table('sage_change',
+                      db.Column('version', db.Integer, primary_key=True),
+                      db.Column('item_id', db.Integer, primary_key=True),
+                      db.Column('menu_id', db.Integer, nullable=False),
+                      # One of insert, update or delete
+                      db.Column('change', db.Text, nullable=False),
+                      db.Index('ix_sage_change_menu_version', 'menu_id', 'version')
+                      )
+
+# Every recipe a save added or changed the name or allergens of, under the data version it
+# made. Recipes are never deleted
+SageRecipeChange = db.Table('sage_recipe_change',
+                            db.Column('version', db.Integer, primary_key=True),
+                            db.Column('recipe_id', db.Integer, primary_key=True)
+                            )
+
+# Scrapes requested through /scrape. Kept in the db, so every worker can report on any job
+ScrapeJob = db.Table('scrape_job',
+                     db.Column('id', db.Text, primary_key=True),
+                     # One of queued, running, finished or failed
+                     db.Column('status', db.Text, nullable=False),
+                     db.Column('created_at', db.DateTime, nullable=False),
+                     db.Column('started_at', db.DateTime),
+                     # Bumped on every progress report, so dead jobs can be spotted
+                     db.Column('updated_at', db.DateTime, nullable=False),
+                     db.Column('finished_at', db.DateTime),
+                     # A JSON dict of menu name, to a dict of week number to the amount of menu
+                     # items fetched for it
+                     db.Column('progress', db.Text),
+                     db.Column('rows', db.Integer),
+                     db.Column('error', db.Text),
+                     db.Index('ix_scrape_job_status', 'status')
+                     )
+
+
+def get_data_version(session) -> int:
+    '''
+    Returns the current data version, or 0 if no data has ever been saved
+    '''
+    return session.query(DataVersion.c.version).filter(DataVersion.c.id == 1).scalar() or 0
+
+
+def get_data_state(session) -> tuple:
+    '''
+    Returns the current data version and the UTC time it was saved at, or (0, None) if no data
+    has ever been saved
+    '''
+    row = session.query(DataVersion.c.version, DataVersion.c.updated_at).filter(
+        DataVersion.c.id == 1).first()
+    return tuple(row) if row else (0, None)
+
+
+# Bitmasks are stored as signed 64 bit SQLite integers
+MAX_ALLERGENS = 63
+
+
+def get_allergen_bits(session, allergen_ids: set) -> dict:
+    '''
+    Returns a dict of Sage allergen id to its bit in allergen bitmasks, giving new allergens the
+    next free bit. Doesn't commit
+
+    allergen_ids: the Sage allergen ids to look up
+    '''
+    for allergen_id in allergen_ids:
+        # The next free bit is the amount of allergens so far. Done in one statement, so
+        # scrapes running at the same time can't hand out the same bit twice
+        session.execute(text('INSERT OR IGNORE INTO sage_allergen (id, bit) '
+                             'SELECT :id, COUNT(*) FROM sage_allergen'), {'id': allergen_id})
+
+    bits = dict(session.query(SageAllergen.c.id, SageAllergen.c.bit).all())
+    if len(bits) > MAX_ALLERGENS:
+        raise ValueError(f'More than {MAX_ALLERGENS} allergens can\'t fit in a bitmask')
+
+    return bits
+
+
+def sync_recipe_search(session, recipe_ids):
+    '''
+    Copies the current names of some recipes into the search index. Doesn't commit
+
+    recipe_ids: a select of the recipe ids that changed
+    '''
+    session.execute(RecipeSearch.delete().where(RecipeSearch.c.rowid.in_(recipe_ids)))
+    session.execute(RecipeSearch.insert().from_select(
+        ['rowid', 'name'], select(SageRecipe.c.recipe_id, SageRecipe.c.name).where(
+            SageRecipe.c.recipe_id.in_(recipe_ids))))
+
+
+def get_change_log_start(session) -> int:
+    '''
+    Returns the data version the change log starts at. Changes after it are all in the log
+    '''
+    return session.query(DataVersion.c.change_log_start).filter(
+        DataVersion.c.id == 1).scalar() or 0
+
+
+def has_changes_since(session, version: int) -> bool:
+    '''
+    Returns whether any menu item or recipe changed after a data version, going by the change log
+    '''
+    return any(session.query(exists().where(change_log.c.version > version)).scalar()
+               for change_log in (SageChange, SageRecipeChange))
+
+
+def bump_data_version(session) -> int:
+    '''
+    Increments the data version, and returns the new one. Doesn't commit, so the bump lands in
+    the same transaction as the data change that caused it
+    '''
+    now = datetime.utcnow()
+    result = session.execute(DataVersion.update().where(DataVersion.c.id == 1).values(
+        version=DataVersion.c.version + 1, updated_at=now))
+
+    if not result.rowcount:
+        # No row yet, so this is the first save ever
+        session.execute(DataVersion.insert().values(id=1, version=1, updated_at=now))
+        return 1
+
+    return get_data_version(session)
+
+
+def enable_wal(engine):
+    '''
+    Puts every SQLite connection of an engine in WAL mode, so reads aren't blocked by a write
+    '''
+    #pylint: disable=unused-argument
+    @event.listens_for(engine, 'connect')
+    def set_journal_mode(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.close()
+
+
+def enable_query_only(engine):
+    '''
+    Makes every SQLite connection of an engine refuse writes, for processes that only serve the
+    menu. Has to be called after enable_wal, as switching to WAL is a write
+    '''
+    #pylint: disable=unused-argument
+    @event.listens_for(engine, 'connect')
+    def set_query_only(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+
+
+def dispose_after_fork(engine):
+    '''
+    Makes forked children of this process, like gunicorn workers started with --preload, drop the
+    connections they inherited without closing them, as they still belong to the parent
+    '''
+    def drop_inherited_connections():
+        try:
+            engine.dispose(close=False)
+        except TypeError:
+            # SQLAlchemy before 1.4.33 can't dispose without closing, so swap in a new pool and
+            # leave the connections of the old one alone, like dispose(close=False) does
+            engine.pool = engine.pool.recreate()
+
+    os.register_at_fork(after_in_child=drop_inherited_connections)
@@ -0,0 +1,75 @@
+import base64
+import binascii
+import json
+from datetime import datetime, timedelta
+
+# Which way a cursor pages from its boundary date
+CURSOR_DIRECTIONS = ('after', 'before')
+
+def encode_date_cursor(direction: str, boundary) -> str:
+    '''
+    Makes an opaque cursor for the page of dates right after or right before a date
+
+    direction: one of CURSOR_DIRECTIONS
+    boundary: the date the page starts after, or ends before
+    '''
+    position = [direction, boundary.strftime('%Y-%m-%d')]
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode(
+        'ascii').rstrip('=')
+
+def decode_date_cursor(cursor: str) -> tuple:
+    '''
+    Turns a cursor from encode_date_cursor back into the (direction, boundary) it was made from
+
+    raises CursorError if the cursor isn't one
+    '''
+    try:
+        # The padding is stripped to keep cursors url friendly, so it has to be put back
+        position = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        direction, boundary = position
+        if direction not in CURSOR_DIRECTIONS:
+            raise ValueError(direction)
+        return direction, datetime.strptime(boundary, '%Y-%m-%d').date()
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise CursorError('Invalid Cursor') from None
+
+def cursor_window(cursor: str, days: int) -> tuple:
+    '''
+    Turns a cursor into the start and days to give Fetcher.fetch_days, so the page is a single
+    seek from the boundary date, however far it is from today
+
+    cursor: a cursor from encode_date_cursor
+    days: the amount of days in a page
+
+    returns: a tuple of (start date, days), where days is negative for pages before the boundary
+    '''
+    direction, boundary = decode_date_cursor(cursor)
+    if direction == 'after':
+        return boundary + timedelta(days=1), abs(days)
+
+    return boundary - timedelta(days=1), -abs(days)
+
+def page_cursors(bounds: tuple, start, days: int) -> tuple:
+    '''
+    Makes the cursors for the pages before and after a page
+
+    bounds: the first and last dates of the page, from Fetcher.fetch_page_bounds, or None if the
+        page is empty
+    start: the start date the page was fetched with
+    days: the days the page was fetched with
+
+    returns: a tuple of the (previous, next) cursors
+    '''
+    if bounds:
+        first, last = bounds
+    elif days > 0:
+        # An empty page still has neighbours, on either side of where it would have started
+        first, last = start, start - timedelta(days=1)
+    else:
+        first, last = start + timedelta(days=1), start
+
+    return encode_date_cursor('before', first), encode_date_cursor('after', last)
+
+
+class CursorError(BaseException):
+    pass
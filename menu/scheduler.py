@@ -0,0 +1,110 @@
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+import pytz
+
+logger = logging.getLogger(__name__)
+
+class ScrapeScheduler:
+    '''
+    Decides when to scrape next, and runs scrapes on that schedule.
+
+    Scrapes happen often near the start of a menu cycle and right after Sage reports changes, and
+    back off exponentially while nothing changes or Sage errors. Delays are jittered, and scrapes
+    never start inside the quiet period, so deployments don't all hit Sage at the same moment
+    '''
+    # What a scrape can turn out as
+    CHANGED = 'changed'
+    UNCHANGED = 'unchanged'
+    ERROR = 'error'
+
+    def __init__(self, timezone: str, min_interval: float = 900, max_interval: float = 21600,
+                 backoff: float = 2, jitter: float = 0.1, quiet_hours: list = None,
+                 early_weeks: int = 1):
+        '''
+        timezone: the tz database timezone the quiet hours are in
+        min_interval: seconds between scrapes while the menu is changing
+        max_interval: the most seconds to ever wait between scrapes
+        backoff: what to multiply the interval by after a scrape with no changes or an error
+        jitter: the fraction of a delay to randomly add or remove, 0.1 is +-10%
+        quiet_hours: (optional) [start hour, end hour] to never scrape in, like [22, 5]
+        early_weeks: the number of weeks at the start of a menu cycle to always scrape at
+            min_interval in, as that's when Sage menus change the most
+        '''
+        self.timezone = pytz.timezone(timezone)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.quiet_hours = quiet_hours
+        self.early_weeks = early_weeks
+
+        self.interval = min_interval
+
+    def next_delay(self, outcome: str, current_week: int = None) -> float:
+        '''
+        Updates the interval with the result of a scrape, and returns how many seconds to wait
+        until the next one
+
+        outcome: one of CHANGED, UNCHANGED or ERROR
+        current_week: (optional) the current week of the menu cycle, if known
+        '''
+        if outcome == self.CHANGED:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+
+        interval = self.interval
+        if current_week is not None and current_week < self.early_weeks:
+            interval = self.min_interval
+
+        delay = interval * (1 + random.uniform(-self.jitter, self.jitter))
+        return self.skip_quiet_hours(delay)
+
+    def skip_quiet_hours(self, delay: float) -> float:
+        '''
+        Pushes a delay back to the end of the quiet hours, if it would end inside them
+        '''
+        if not self.quiet_hours:
+            return delay
+
+        start_hour, end_hour = self.quiet_hours
+        scrape_at = datetime.now(self.timezone) + timedelta(seconds=delay)
+
+        if start_hour <= end_hour:
+            quiet = start_hour <= scrape_at.hour < end_hour
+        else:
+            # The quiet hours wrap around midnight
+            quiet = scrape_at.hour >= start_hour or scrape_at.hour < end_hour
+
+        if not quiet:
+            return delay
+
+        end = scrape_at.replace(hour=end_hour, minute=0, second=0, microsecond=0, tzinfo=None)
+        if end_hour <= scrape_at.hour:
+            end += timedelta(days=1)
+        end = self.timezone.localize(end)
+
+        # Spread the end of the quiet hours out a bit too, so everyone doesn't wake up at once
+        spread = self.min_interval * random.uniform(0, self.jitter)
+        return (end - datetime.now(self.timezone)).total_seconds() + spread
+
+    def run(self, scrape, sleep=time.sleep):
+        '''
+        Scrapes forever, waiting next_delay between scrapes
+
+        scrape: a function that takes no arguments, scrapes, and returns a tuple of the outcome
+            (CHANGED, UNCHANGED or ERROR) and the current week (or None). Anything it raises is
+            logged and counts as an ERROR, so the schedule keeps going
+        sleep: the function used to wait
+        '''
+        while True:
+            try:
+                outcome, current_week = scrape()
+            #pylint: disable=broad-except
+            except Exception:
+                # Like the db being locked while queueing the scrape. Backing off gives it time
+                logger.exception('Scheduled scrape failed')
+                outcome, current_week = self.ERROR, None
+            sleep(self.next_delay(outcome, current_week))
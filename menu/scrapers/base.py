@@ -6,10 +6,25 @@ class BaseScraper(ABC):
         The base scraper all sub-scrapers pull from
 
         base_url: base url of the service data is being pulled from. Used to build urls
-        table_name: the sql table to store menu data in
-        cursor: an sqlite3 cursor connected to the cache db
         '''
         self.base_url = base_url
+        # functions to call with no arguments once a scrape is finished
+        self.post_scrape_hooks = []
+
+    def add_post_scrape_hook(self, hook):
+        '''
+        Registers a function to be called once a scrape is finished
+
+        hook: a function that takes no arguments
+        '''
+        self.post_scrape_hooks.append(hook)
+
+    def run_post_scrape_hooks(self):
+        '''
+        Calls every registered post scrape hook, should be called at the end of scrape
+        '''
+        for hook in self.post_scrape_hooks:
+            hook()
 
     def build_url(self, resource: str):
         '''
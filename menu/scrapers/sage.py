@@ -1,10 +1,23 @@
+import gzip
+import hashlib
+import html
 import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import timedelta, datetime, date
-from requests import Session
+from os import path
+from threading import Lock, RLock
 from flask_sqlalchemy import SQLAlchemy
 from menu.scrapers.base import BaseScraper
-from menu.models import SageMenuItem
+from sqlalchemy import case, literal, select, tuple_
+from menu.metrics import metrics
+from menu.models import (SageChange, SageMenuCycle, SageMenuItem, SageMenuItemStaging,
+                         SageMenuState, SageRecipe, SageRecipeChange, SageToken, SageWeekHash,
+                         SageWordify, ServedDate, bump_data_version, get_allergen_bits,
+                         sync_recipe_search)
 
 # A dict of that corresponds the dot attribute found in a menu item to the allergy colors
 # it needs displayed
@@ -15,6 +28,20 @@ DOT_TO_COLORS = {1: ['red'], 2: ['yellow'], 3: ['green'], 4: ['green', 'yellow']
 STATION_TITLES = ['Stock Exchange', 'Improvisations', 'Classic Cuts Deli', 'Main Ingredient',
                   'Seasonings', 'Crossroads', 'Mangia!', 'Transit Fare', 'P.S.', 'Splashes',None,None,None,None,None,'FreeStyle',None,None,None,None,"Trattoria", "Ladle & Co."]
 
+# The base url of the Sage customer app API, see SAGE_API.md
+SAGE_BASE_URL = 'https://sagedining.com/rest/SageRest/v1/public/customerapp'
+
+# HTTP statuses from Sage that are worth retrying, as they're usually temporary
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# The extension of archived raw weeks, which are gzipped JSON
+ARCHIVE_SUFFIX = '.json.gz'
+
+# How long a Sage access token lasts, and how long before that to stop using it, so requests
+# already on their way don't get rejected
+TOKEN_LIFETIME = timedelta(hours=1)
+TOKEN_EXPIRY_MARGIN = timedelta(minutes=5)
+
 @dataclass
 class SageConfig:
     '''
@@ -24,11 +51,119 @@ class SageConfig:
     password str: password corresponding with the email address
     unit_id int: the school unit id found in /findschool from the Sage API
     menu_id int: the menu id to scrape. Found in /getmenus from the Sage API
+    workers int: the max amount of weeks to fetch from Sage at the same time
+    retries int: how many times to retry a request that failed for a temporary reason
+    backoff float: the backoff factor (in seconds) to wait between retries
+    incremental bool: skip the scrape if Sage reports no changes, and only rewrite changed weeks
+    batch_size int: how many menu items to write to the staging table at once
+    rate_limit float: the max amount of requests per second to send Sage, 0 for no limit
+    archive_dir str: (optional) a directory to archive every raw week Sage sends to, see
+        menu/archive.py
     '''
     email: str
     password: str
     unit_id: int
     menu_id: int
+    workers: int = 1
+    retries: int = 3
+    backoff: float = 0.5
+    incremental: bool = False
+    batch_size: int = 500
+    rate_limit: float = 0
+    archive_dir: str = None
+
+
+class RateLimiter:
+    '''
+    Spaces out calls to wait, so they don't happen more than a set amount of times per second
+    '''
+    def __init__(self, per_second: float):
+        '''
+        per_second: the max amount of calls per second, 0 for no limit
+        '''
+        self.interval = 1 / per_second if per_second else 0
+        self.next_time = 0
+        self.lock = Lock()
+
+    def wait(self):
+        '''
+        Blocks until another call is allowed
+        '''
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class SageAccount:
+    '''
+    A Sage login and the session it's used on. Scrapers of menus that use the same account share
+    one, so they only log in once and reuse the same connections
+    '''
+    def __init__(self, email: str, password: str, session: 'Session'):
+        self.email = email
+        self.password = password
+        self.session = session
+        self.access_token = None
+        # When the access token stops working, in UTC
+        self.expires_at = None
+        # Whether the access token is in the db yet. Tokens from a login after a 401 on a worker
+        # thread are saved later, as workers can't use the db
+        self.token_saved = False
+        # Held while logging in, so scrapers sharing the account don't all log in at once
+        self.lock = RLock()
+
+    def has_valid_token(self) -> bool:
+        '''
+        Returns True if the account has an access token that hasn't expired
+        '''
+        return self.access_token is not None and self.expires_at > datetime.utcnow()
+
+    def set_token(self, access_token: str, expires_at: datetime, saved: bool):
+        '''
+        Starts sending an access token with every request on the session
+
+        access_token: the access token from /login
+        expires_at: when the token expires, in UTC
+        saved: whether the token is already in the db
+        '''
+        self.access_token = access_token
+        self.expires_at = expires_at
+        self.token_saved = saved
+        self.session.headers.update({'Authorization': f'Bearer {access_token}'})
+
+
+def share_accounts(configs: list, accounts: dict = None) -> list:
+    '''
+    Returns a SageAccount for each SageConfig, where configs with the same email and password
+    share an account. Shared sessions get a connection pool big enough for all their workers
+
+    configs: the SageConfigs of every scraper
+    accounts: (optional) a dict of (email, password) to SageAccount kept between calls, so
+        later scrapes reuse the access tokens and connections of earlier ones
+    '''
+    if accounts is None:
+        accounts = {}
+
+    grouped = {}
+    for config in configs:
+        grouped.setdefault((config.email, config.password), []).append(config)
+
+    for (email, password), group in grouped.items():
+        if (email, password) in accounts:
+            continue
+
+        pool_size = sum(max(config.workers, 1) for config in group)
+        accounts[(email, password)] = SageAccount(
+            email, password, SageScraper.build_session(group[0], pool_size=pool_size))
+
+    return [accounts[(config.email, config.password)] for config in configs]
 
 
 class SageDateHandler:
@@ -126,48 +261,278 @@ class SageDateHandler:
 
 
 class SageScraper(BaseScraper):
-    def __init__(self, config: SageConfig, db: SQLAlchemy):
+    def __init__(self, config: SageConfig, db: SQLAlchemy, base_url: str = SAGE_BASE_URL,
+                 progress=None, account: SageAccount = None):
         '''
         Sets up a scraper conforming to BaseScraper
 
         config: SageConfig with info only relevant to SageScraper
-        table_name: the sql table to store menu data in
-        cursor: an sqlite3 cursor connected to the cache db
+        db: SQLAlchemy Instance to store menu data in
+        base_url: the Sage API url, can be pointed at a local stub of the Sage API
+        progress: (optional) a function called with the week number and the amount of menu items
+            fetched for it, every time a week is done
+        account: (optional) a SageAccount shared with other scrapers using the same login,
+            see share_accounts
         '''
         self.config = config
-        self.session = Session()
+        self.progress = progress
+        self.account = account or SageAccount(config.email, config.password,
+                                              self.build_session(config))
+        self.session = self.account.session
+        self.rate_limiter = RateLimiter(config.rate_limit)
         self.db = db
-        self.base_url = 'https://sagedining.com/rest/SageRest/v1/public/customerapp'
-        super().__init__(self.base_url)
+        super().__init__(base_url)
+
+    @staticmethod
+    def build_session(config: SageConfig, pool_size: int = None) -> 'Session':
+        '''
+        Builds a requests Session with a connection pool big enough for every worker, that retries
+        temporary failures with an exponential backoff
 
-    def scrape(self):
+        config: SageConfig with the worker and retry settings
+        pool_size: (optional) the connection pool size, defaults to the config's worker count
+        '''
+        #pylint: disable=import-outside-toplevel
+        # Imported here, so processes that only serve the menu never load requests
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(total=config.retries, backoff_factor=config.backoff,
+                      status_forcelist=RETRY_STATUSES,
+                      # getmenuitems is a POST, but it only reads data, so it's safe to retry
+                      allowed_methods=frozenset(['GET', 'POST']))
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=pool_size or max(config.workers, 1),
+                              max_retries=retry)
+
+        session = Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def scrape(self) -> int:
         '''
         Main controller for scraping data.
 
         Calls subfunctions to wrap it all together
+
+        returns: the amount of menu items saved
         '''
-        # Fetch the access token by logging in, and add it to the session
-        access_token = self.login(self.config.email, self.config.password)
-        self.session.headers.update({'Authorization': f'Bearer {access_token}'})
+        # Log in, unless there is still a working access token from an earlier scrape
+        self.authenticate()
+
+        last_update = None
+        week_hashes = {}
+
+        if self.config.incremental:
+            last_update = self.get_last_update(self.config.menu_id)
+            if last_update:
+                # If we've scraped before, ask Sage if anything changed since then
+                update = self.check_menu_last_update(self.config.menu_id, last_update)
+                if not update['menuUpdate']:
+                    self.run_post_scrape_hooks()
+                    return 0
+
+                last_update = update['newLastUpdate']
+
+            week_hashes = self.get_week_hashes(self.config.menu_id)
 
         # Fetch information about the menu to scrape
-        menu = self.get_menu(self.config.unit_id, self.config.menu_id)
+        with metrics.timer('sage_get_menu'):
+            menu = self.get_menu(self.config.unit_id, self.config.menu_id)
 
         # create a date_handler for the get_menu_items to use
         date_handler = SageDateHandler(int(menu['cycleLength']), menu['menuFirstDate'])
+        self.save_cycle(menu)
 
-        menu_items = []
+        # Clear out anything left over from a scrape that didn't finish
+        self.clear_staging()
+
+        pending_items = []
+        staged_count = 0
+        changed_hashes = {}
 
         current_week = date_handler.get_current_week()
 
-        # For all the weeks, run get_menu_items for that week and format the data
-        for i in range(current_week, int(menu['cycleLength'])):
-            raw_data = self.get_menu_items(menu['id'], i)
-            if raw_data:
-                menu_items += self.format_data_for_storage(raw_data, date_handler)
+        def fetch_week(week: int) -> tuple:
+            # Fetch and format a single week, so formatting one week overlaps with waiting on others
+            with metrics.timer('sage_get_menu_items'):
+                raw_data = self.get_menu_items(menu['id'], week)
+            metrics.inc('sage_weeks_scraped_total', menu=menu['id'])
+            if not raw_data:
+                return week, None, []
+            metrics.inc('sage_rows_scraped_total', len(raw_data), menu=menu['id'])
+
+            # Hash before formatting, as formatting pops fields out of the raw items
+            week_hash = self.hash_week(raw_data, menu)
+            if week_hashes.get(week) == week_hash:
+                # The week is the same as what's already stored, so don't rewrite it
+                return week, None, []
+
+            if self.config.archive_dir:
+                # Formatting changes the payload, so archive it first, exactly as Sage sent it
+                self.archive_week(menu, week, date_handler, raw_data)
+
+            with metrics.timer('scrape_format'):
+                return week, week_hash, self.format_data_for_storage(raw_data, date_handler)
+
+        # For all the weeks, run get_menu_items for that week and format the data, then stream it
+        # into the staging table in batches
+        # Weeks come back in order, so the result matches fetching one week at a time
+        workers = max(self.config.workers, 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for week, week_hash, week_items in bounded_map(
+                    executor, fetch_week, range(current_week, int(menu['cycleLength'])),
+                    workers * 2):
+                pending_items += week_items
+                if week_hash:
+                    changed_hashes[week] = week_hash
+
+                if len(pending_items) >= self.config.batch_size:
+                    self.stage(pending_items)
+                    staged_count += len(pending_items)
+                    pending_items = []
+
+                if self.progress:
+                    self.progress(week, len(week_items))
+
+        if pending_items:
+            self.stage(pending_items)
+            staged_count += len(pending_items)
+
+        # A worker may have logged in again after a 401, and only this thread can save the token
+        self.save_token()
+
+        if staged_count:
+            self.swap()
+
+        if self.config.incremental:
+            self.save_state(int(menu['id']), last_update or menu['lastUpdate'], changed_hashes)
+
+        self.run_post_scrape_hooks()
+
+        return staged_count
+
+    @staticmethod
+    def hash_week(raw_data: list, menu: dict) -> str:
+        '''
+        Hashes a week's raw getmenuitems payload, along with the menu start date,
+        as the same payload lands on different dates if the menu start date moves
 
-        self.save(menu_items)
+        raw_data: the items from a /getmenuitems response
+        menu: the menu object from /getmenus
+        '''
+        payload = json.dumps({'first_date': menu['menuFirstDate'], 'items': raw_data},
+                             sort_keys=True)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def authenticate(self):
+        '''
+        Makes sure the session has a working access token, unless another scraper sharing the
+        account already did. Reuses the token of an earlier scrape until it expires, even one
+        saved to the db by another process, and only logs in when there isn't one
+        '''
+        with self.account.lock:
+            if self.account.has_valid_token():
+                return
+
+            token = self.get_saved_token(self.config.email)
+            if token and token.expires_at > datetime.utcnow():
+                self.account.set_token(token.access_token, token.expires_at, saved=True)
+                # Another process saved it, so make sure Sage still takes it with a cheap request
+                # before every worker uses it
+                if self.request('GET', 'dataPull', reauthenticate=False).status_code != 401:
+                    return
+
+            self.log_in()
+            self.save_token()
+
+    def log_in(self):
+        '''
+        Logs in and starts using the new access token. Has to be called with the account lock held
+        '''
+        with metrics.timer('sage_login'):
+            access_token = self.login(self.config.email, self.config.password)
+        # Sage tokens last for an hour, see SAGE_API.md. accessTokenExpiry isn't used, as it
+        # doesn't say which timezone it's in
+        self.account.set_token(access_token,
+                               datetime.utcnow() + TOKEN_LIFETIME - TOKEN_EXPIRY_MARGIN,
+                               saved=False)
+
+    def reauthenticate(self, rejected_token: str):
+        '''
+        Logs in again after Sage rejected an access token, unless another scraper sharing the
+        account already has
 
+        rejected_token: the access token the rejected request was sent with
+        '''
+        with self.account.lock:
+            if self.account.access_token == rejected_token:
+                self.log_in()
+
+    def get_saved_token(self, email: str):
+        '''
+        Returns the saved access_token and expires_at of an account, or None if there isn't one
+        '''
+        return self.db.session.query(SageToken.c.access_token, SageToken.c.expires_at).filter(
+            SageToken.c.email == email).first()
+
+    def save_token(self):
+        '''
+        Saves the account's access token, so later scrapes and other processes can use it
+        '''
+        with self.account.lock:
+            if self.account.token_saved:
+                return
+
+            self.db.session.execute(SageToken.insert().prefix_with('OR REPLACE'),
+                                    {'email': self.config.email,
+                                     'access_token': self.account.access_token,
+                                     'expires_at': self.account.expires_at})
+            self.db.session.commit()
+            self.account.token_saved = True
+
+    def request(self, method: str, resource: str, reauthenticate: bool = True,
+                **kwargs) -> 'Response':
+        '''
+        Sends a request to the Sage API, keeping to the rate limit. If Sage rejects the access
+        token, it logs in again and retries once
+
+        method: the HTTP method
+        resource: the path after the base_url
+        reauthenticate: whether to log in again and retry if Sage rejects the access token
+        kwargs: passed on to requests
+        '''
+        access_token = self.account.access_token
+        response = self.send(method, resource, **kwargs)
+
+        if response.status_code == 401 and reauthenticate and resource != 'login':
+            self.reauthenticate(access_token)
+            response = self.send(method, resource, **kwargs)
+
+        return response
+
+    def send(self, method: str, resource: str, **kwargs) -> 'Response':
+        '''
+        Sends a single request to the Sage API, keeping to the rate limit
+
+        method: the HTTP method
+        resource: the path after the base_url
+        kwargs: passed on to requests
+        '''
+        self.rate_limiter.wait()
+
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            response = self.session.request(method, self.build_url(resource), **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            # Retries happen inside the session, so this is the time the caller waited
+            metrics.observe('sage_request_duration_seconds', time.perf_counter() - start,
+                            resource=resource, status=status)
 
     def login(self, email: str, password: str) -> str:
         '''
@@ -177,8 +542,7 @@ class SageScraper(BaseScraper):
         password: password corresponding to provided email
         '''
         payload = {'grant': 'password'}
-        response = self.session.post(self.build_url('login'),
-                                     json=payload, auth=(email, password)).json()
+        response = self.request('POST', 'login', json=payload, auth=(email, password)).json()
         access_token = response['credentials']['accessToken']
         return access_token
 
@@ -188,7 +552,25 @@ class SageScraper(BaseScraper):
 
         Returns the API response
         '''
-        return self.session.get(self.build_url('dataPull')).json()
+        return self.request('GET', 'dataPull').json()
+
+    def check_menu_last_update(self, menu_id: int, last_update: str) -> dict:
+        '''
+        Calls the /checkMenuLastUpdate function as described in the SAGE_API.md
+
+        menu_id: the id of the menu to check
+        last_update: the newLastUpdate value from the last time the menu was checked
+
+        Returns the API response, with menuUpdate and newLastUpdate keys
+        '''
+        response = self.request('GET', 'checkMenuLastUpdate',
+                                params={'menuId': menu_id, 'lastUpdate': last_update}).json()
+
+        if response['error']:
+            # If the api raises an error, we raise it as well
+            raise SageAPIError(response['reason'])
+
+        return response
 
     def get_menu(self, unit_id: int, menu_id: int) -> dict:
         '''
@@ -197,8 +579,7 @@ class SageScraper(BaseScraper):
         The object returned is one member of the 'menus' array found in the response of /getmenus
         '''
         # Hit the API for provided school and get data for our requested menu
-        menus_response = self.session.get(
-            self.build_url('getmenus'), params={'unitId': unit_id}).json()
+        menus_response = self.request('GET', 'getmenus', params={'unitId': unit_id}).json()
 
         if menus_response['error']:
             # If the api raises an error, we raise it as well
@@ -224,7 +605,7 @@ class SageScraper(BaseScraper):
         '''
         payload = {'id': menu_id, 'week': week}
         # Hit the /getMenusItems API
-        response = self.session.post(self.build_url('getmenuitems'), json=payload).json()
+        response = self.request('POST', 'getmenuitems', json=payload).json()
 
         if response['error']:
             # If the api raises an error, we raise it as well
@@ -232,6 +613,32 @@ class SageScraper(BaseScraper):
 
         return response['items']
 
+    def archive_week(self, menu: dict, week: int, date_handler: SageDateHandler, raw_data: list):
+        '''
+        Writes a week's raw getmenuitems payload to the archive, as
+        <archive_dir>/<menu id>/<date of the week's Sunday>/<fetch time>.json.gz, along with the
+        menu details needed to date it. Files are never changed once they're written
+
+        menu: the menu, as /getmenus describes it
+        week: the week number of the payload
+        date_handler: the SageDateHandler of the menu
+        raw_data: the payload, before formatting
+        '''
+        fetched_at = datetime.utcnow()
+        week_dir = path.join(self.config.archive_dir, str(menu['id']),
+                             date_handler.sage_to_date(week, 0).isoformat())
+        file_path = path.join(week_dir, fetched_at.strftime('%Y%m%dT%H%M%S%fZ') + ARCHIVE_SUFFIX)
+        os.makedirs(week_dir, exist_ok=True)
+
+        archived = {'menu': {'id': menu['id'], 'menuFirstDate': menu['menuFirstDate'],
+                             'cycleLength': menu['cycleLength']},
+                    'week': week, 'fetchedAt': fetched_at.isoformat() + 'Z', 'items': raw_data}
+
+        # Written under a temporary name and renamed, so a crash never leaves half a file behind
+        with gzip.open(file_path + '.tmp', 'wt', encoding='utf-8') as f:
+            json.dump(archived, f)
+        os.replace(file_path + '.tmp', file_path)
+
     @staticmethod
     def format_data_for_storage(menu_data: list, date_handler: SageDateHandler) -> list:
         # Grabbing the week off the first menu item to gen a date list
@@ -255,8 +662,11 @@ class SageScraper(BaseScraper):
             formatted_item = {'id': int(i.pop('id')), 'menu_id': int(i.pop('menuId')),
                               'recipe_id': int(i.pop('recipeId')), 'day': int(i.pop('day')),
                               'week': int(i.pop('week')), 'meal': int(i.pop('meal')),
-                              'station': int(i.pop('station')), 'name': i.pop('name'),
-                              'allergens': json.dumps(i.pop('allergens')), 'date': date,
+                              'station': int(i.pop('station')),
+                              # Sage sends some names html escaped, like Mac &amp; Cheese
+                              'name': html.unescape(i.pop('name')),
+                              'allergens': [int(allergen['id']) for allergen in i.pop('allergens')],
+                              'date': date,
                               'card': int(i.pop('card')), 'dot': int(i.pop('dot')),
                               'misc': json.dumps(i)}
 
@@ -269,27 +679,192 @@ class SageScraper(BaseScraper):
         Takes menu data and stores it in the db using the provided SQLAlchemy Instance
 
         menu_data: list: A list of properly formatted SageMenuItems
-        db: SQLAlchemy Instance
         '''
+        self.clear_staging()
+        self.stage(menu_data)
+        self.swap()
+
+    def clear_staging(self):
+        '''
+        Empties this menu's part of the staging table
+        '''
+        self.db.session.execute(SageMenuItemStaging.delete().where(
+            SageMenuItemStaging.c.menu_id == self.config.menu_id))
+        self.db.session.commit()
 
-        # get all unique dates in the menu_data
-        unique_dates = {i['date'] for i in menu_data}
+    def stage(self, menu_data: list):
+        '''
+        Writes a batch of menu data to the staging table, readers don't see it until swap is called
 
-        # then, with those unique dates, remove all menu_data that has the same date as the data
-        # we are about to insert
+        menu_data: list: A list of properly formatted SageMenuItems
+        '''
+        with metrics.timer('scrape_stage'):
+            # Turn each item's list of allergen ids into a bitmask, for filtering, and keep the
+            # list itself, for its order
+            bits = get_allergen_bits(self.db.session,
+                                     {allergen for i in menu_data for allergen in i['allergens']})
+            menu_data = [dict(i, allergens=sum(1 << bits[allergen]
+                                               for allergen in set(i['allergens'])),
+                              allergen_ids=','.join(str(allergen) for allergen in i['allergens']))
+                         for i in menu_data]
+
+            # creates an inserter object so duplicates replace their predecessor
+            inserter = SageMenuItemStaging.insert().prefix_with('OR REPLACE')
+            self.db.session.execute(inserter, menu_data)
+            self.db.session.commit()
+
+    def swap(self):
+        '''
+        Replaces the menu data for every date in this menu's part of the staging table with the
+        staged data, in a single transaction, then empties it. Other menus are left alone, so
+        several menus can be scraped at once
+        '''
+        staged_items = select(*[SageMenuItemStaging.c[column.name] for column in SageMenuItem.c])
+        staged_items = staged_items.where(SageMenuItemStaging.c.menu_id == self.config.menu_id)
+        staged_recipes = select(*[SageMenuItemStaging.c[column.name] for column in SageRecipe.c])
+        staged_recipes = staged_recipes.where(
+            SageMenuItemStaging.c.menu_id == self.config.menu_id).group_by(
+                SageMenuItemStaging.c.recipe_id)
+        staged_dates = select(SageMenuItemStaging.c.menu_id, SageMenuItemStaging.c.date).where(
+            SageMenuItemStaging.c.menu_id == self.config.menu_id).distinct()
+
+        # Let every Fetcher know its cached data is out of date. The changes are logged under the
+        # new version, all in the same transaction
+        version = bump_data_version(self.db.session)
+
+        with metrics.timer('swap_log_changes'):
+            self.log_changes(version, staged_items, staged_recipes, staged_dates)
+
+        # With the unique dates in the staging table, remove all menu_data that has the same date
+        # as the data we are about to insert
         # this is done because sometimes sage changes their menus, and if you leave in existing
         # entries, you'll have extra entries for a given day that aren't accurate
-        delete_query = SageMenuItem.delete().where(SageMenuItem.c.date.in_(unique_dates))
+        with metrics.timer('swap_delete'):
+            self.db.session.execute(SageMenuItem.delete().where(
+                tuple_(SageMenuItem.c.menu_id, SageMenuItem.c.date).in_(staged_dates)))
+
+        with metrics.timer('swap_insert'):
+            # Duplicates replace their predecessor, and recipes are updated to their latest version
+            self.db.session.execute(SageMenuItem.insert().prefix_with('OR REPLACE').from_select(
+                [column.name for column in SageMenuItem.c], staged_items))
+            self.db.session.execute(SageRecipe.insert().prefix_with('OR REPLACE').from_select(
+                [column.name for column in SageRecipe.c], staged_recipes))
+            # Search has to find recipes by their latest names
+            sync_recipe_search(self.db.session, select(SageMenuItemStaging.c.recipe_id).where(
+                SageMenuItemStaging.c.menu_id == self.config.menu_id).distinct())
+
+            # Record the dates that now have menu data, for Fetcher.fetch_valid_dates
+            self.db.session.execute(ServedDate.insert().prefix_with('OR IGNORE').from_select(
+                ['menu_id', 'date'], staged_dates))
+
+            # The spoken menus of these dates are out of date, Fetcher.store_wordify remakes them
+            self.db.session.execute(SageWordify.delete().where(
+                tuple_(SageWordify.c.menu_id, SageWordify.c.date).in_(staged_dates)))
+
+        self.db.session.execute(SageMenuItemStaging.delete().where(
+            SageMenuItemStaging.c.menu_id == self.config.menu_id))
+        with metrics.timer('swap_commit'):
+            self.db.session.commit()
+
+    def log_changes(self, version: int, staged_items, staged_recipes, staged_dates):
+        '''
+        Records which menu items and recipes swap is about to insert, update or delete in the
+        change log, by comparing the staged data with the stored data. Has to run before swap
+        replaces anything
 
-        self.db.session.execute(delete_query)
+        version: the data version the swap makes
+        staged_items, staged_recipes, staged_dates: the selects of staged data from swap
+        '''
+        menu_id = self.config.menu_id
+
+        # Staged items that aren't stored exactly the same way are either new or changed
+        changed_items = staged_items.except_(select(*SageMenuItem.c)).subquery()
+        self.db.session.execute(SageChange.insert().from_select(
+            ['version', 'item_id', 'menu_id', 'change'],
+            select(literal(version), changed_items.c.id, literal(menu_id),
+                   case((changed_items.c.id.in_(select(SageMenuItem.c.id)), 'update'),
+                        else_='insert'))))
+
+        # Stored items on the staged dates that aren't staged again are about to be deleted
+        staged_ids = select(SageMenuItemStaging.c.id).where(
+            SageMenuItemStaging.c.menu_id == menu_id)
+        self.db.session.execute(SageChange.insert().from_select(
+            ['version', 'item_id', 'menu_id', 'change'],
+            select(literal(version), SageMenuItem.c.id, literal(menu_id), literal('delete')).where(
+                tuple_(SageMenuItem.c.menu_id, SageMenuItem.c.date).in_(staged_dates),
+                SageMenuItem.c.id.not_in(staged_ids))))
+
+        changed_recipes = staged_recipes.except_(select(*SageRecipe.c)).subquery()
+        self.db.session.execute(SageRecipeChange.insert().from_select(
+            ['version', 'recipe_id'], select(literal(version), changed_recipes.c.recipe_id)))
+
+    def get_last_update(self, menu_id: int) -> str:
+        '''
+        Returns the stored newLastUpdate watermark for a menu, or None if it was never scraped
+        '''
+        return self.db.session.query(SageMenuState.c.last_update).filter(
+            SageMenuState.c.menu_id == menu_id).scalar()
+
+    def get_week_hashes(self, menu_id: int) -> dict:
+        '''
+        Returns the stored payload hashes for a menu as a dict of week number to hash
+        '''
+        rows = self.db.session.query(SageWeekHash.c.week, SageWeekHash.c.hash).filter(
+            SageWeekHash.c.menu_id == menu_id).all()
+        return {week: week_hash for week, week_hash in rows}
+
+    def save_cycle(self, menu: dict):
+        '''
+        Stores the cycle length and first date of a menu, so the scheduler can work out the
+        current week of the cycle without asking Sage
+
+        menu: the menu, as returned by get_menu
+        '''
+        self.db.session.execute(SageMenuCycle.insert().prefix_with('OR REPLACE'),
+                                {'menu_id': int(menu['id']),
+                                 'cycle_length': int(menu['cycleLength']),
+                                 'first_date': menu['menuFirstDate']})
         self.db.session.commit()
 
-        # creates an inserter object so duplicates replace their predecessor
-        inserter = SageMenuItem.insert().prefix_with('OR REPLACE')
-        self.db.session.execute(inserter, menu_data)
+    def save_state(self, menu_id: int, last_update: str, week_hashes: dict):
+        '''
+        Stores the watermark and the hashes of the weeks that were just saved
+
+        menu_id: the id of the scraped menu
+        last_update: the newLastUpdate value to compare against next time
+        week_hashes: dict of week number to the hash of its payload
+        '''
+        self.db.session.execute(SageMenuState.insert().prefix_with('OR REPLACE'),
+                                {'menu_id': menu_id, 'last_update': last_update})
+
+        if week_hashes:
+            self.db.session.execute(SageWeekHash.insert().prefix_with('OR REPLACE'),
+                                    [{'menu_id': menu_id, 'week': week, 'hash': week_hash}
+                                     for week, week_hash in week_hashes.items()])
+
         self.db.session.commit()
 
 
+def bounded_map(executor, func, items, window: int):
+    '''
+    Like executor.map, but with no more than window calls in flight at a time, so results that
+    haven't been used yet don't pile up in memory. Results are yielded in order
+
+    executor: a concurrent.futures Executor
+    func: the function to call with each item
+    items: an iterable of items
+    window: the max amount of calls submitted but not yet yielded
+    '''
+    futures = deque()
+    for item in items:
+        if len(futures) >= window:
+            yield futures.popleft().result()
+        futures.append(executor.submit(func, item))
+
+    while futures:
+        yield futures.popleft().result()
+
+
 class SageDateRangeError(BaseException):
     '''
     An exception to be used when a Sage Date can't be processed
@@ -0,0 +1,94 @@
+import json
+import os
+from collections import namedtuple
+from threading import Lock
+
+# A pre-rendered response body, along with what it was rendered against
+# version: the data version the body was rendered from
+# default_date: the Fetcher default date at render time, as pages change when it rolls over
+# build: the build fingerprint of the app that rendered it, as a deploy can change any page
+Snapshot = namedtuple('Snapshot', ['body', 'mimetype', 'version', 'default_date', 'build'])
+
+
+def make_snapshot(body: bytes, mimetype: str, version: int, default_date, build: str) -> Snapshot:
+    '''
+    Builds a Snapshot for a rendered body
+    '''
+    return Snapshot(body, mimetype, version, default_date.strftime('%Y-%m-%d'), build)
+
+
+class SnapshotStore:
+    '''
+    Holds pre-rendered responses in memory, and optionally on disk so that every worker
+    can serve snapshots rendered by the worker that ran the scrape
+    '''
+    def __init__(self, directory: str = None):
+        '''
+        directory: a directory to keep snapshot files in, or None to only keep them in memory
+        '''
+        self.directory = directory
+        # key: (snapshot, file modification time it was loaded from)
+        self.snapshots = {}
+        self.lock = Lock()
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.snapshot')
+
+    def get(self, key: str) -> Snapshot:
+        '''
+        Returns the snapshot for a key, or None if there isn't one
+        '''
+        with self.lock:
+            snapshot, loaded_mtime = self.snapshots.get(key, (None, None))
+
+        if not self.directory:
+            return snapshot
+
+        try:
+            mtime = os.stat(self.path(key)).st_mtime
+        except FileNotFoundError:
+            return snapshot
+
+        if mtime != loaded_mtime:
+            # Another worker wrote a newer snapshot, so load it
+            snapshot = self.load(key)
+            with self.lock:
+                self.snapshots[key] = (snapshot, mtime)
+
+        return snapshot
+
+    def put(self, key: str, snapshot: Snapshot):
+        '''
+        Stores a snapshot under a key, replacing any older one
+        '''
+        mtime = None
+        if self.directory:
+            mtime = self.dump(key, snapshot)
+
+        with self.lock:
+            self.snapshots[key] = (snapshot, mtime)
+
+    def load(self, key: str) -> Snapshot:
+        # Snapshot files are a line of JSON metadata, followed by the body
+        with open(self.path(key), 'rb') as f:
+            meta = json.loads(f.readline())
+            body = f.read()
+
+        # Only take the fields this version knows about, in case the file is from an older one
+        return Snapshot(body=body, **{field: meta.get(field) for field in Snapshot._fields[1:]})
+
+    def dump(self, key: str, snapshot: Snapshot) -> float:
+        meta = snapshot._asdict()
+        del meta['body']
+
+        # Write to a temporary file and swap it in, so readers never see half a snapshot
+        temp_path = f'{self.path(key)}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps(meta).encode('utf-8') + b'\n')
+            f.write(snapshot.body)
+        os.replace(temp_path, self.path(key))
+
+        return os.stat(self.path(key)).st_mtime
@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from flask_sqlalchemy import SQLAlchemy
+from menu.fetch import Fetcher
+from menu.scrapers.sage import SageConfig
+from menu.wordify import WORDIFY_LOCALES
+
+# Slugs that would clash with the app's own routes
+RESERVED_SLUGS = {'static', 'fetch', 'wordify', 'scrape', 'search', 'next', 'export',
+                  'metrics', 'changes'}
+
+@dataclass
+class Tenant:
+    '''
+    A data class for one Sage menu served by the app
+
+    slug str: the name of the tenant, used in its urls
+    sage dict: the tenant's section of the sage config
+    fetcher Fetcher: the Fetcher for the tenant's menu
+    '''
+    slug: str
+    sage: dict
+    fetcher: Fetcher
+
+    def build_sage_config(self, archive_dir: str = None) -> SageConfig:
+        return SageConfig(self.sage['email'], self.sage['password'],
+                          self.sage['unit_id'], self.sage['menu_id'],
+                          workers=self.sage.get('workers', 1),
+                          incremental=self.sage.get('incremental', False),
+                          rate_limit=self.sage.get('rate_limit', 0),
+                          archive_dir=archive_dir)
+
+
+def load_tenants(config: dict, db: SQLAlchemy, read_only: bool = False) -> OrderedDict:
+    '''
+    Builds a Tenant for every menu in the config. The sage section is either a single menu,
+    which gets the slug "default", or a list of menus that each have a slug
+
+    read_only: whether the fetchers should never write to the db
+
+    returns: an OrderedDict of slug to Tenant, the first tenant is served at the root urls
+    '''
+    sage_sections = config['sage']
+    if isinstance(sage_sections, dict):
+        sage_sections = [dict(sage_sections, slug=sage_sections.get('slug', 'default'))]
+
+    wordify_locales = config.get('wordify_locales', ['en'])
+    for locale in wordify_locales:
+        if locale not in WORDIFY_LOCALES:
+            raise ValueError(f'Wordify locale "{locale}" isn\'t one of '
+                             f'{", ".join(WORDIFY_LOCALES)}')
+
+    tenants = OrderedDict()
+    for sage in sage_sections:
+        slug = sage['slug']
+        if slug in RESERVED_SLUGS or slug in tenants:
+            raise ValueError(f'Menu slug "{slug}" is already in use')
+
+        fetcher = Fetcher(db, sage.get('timezone', config['timezone']), sage['menu_titles'],
+                          cache_size=config.get('cache_size', 128), menu_id=sage['menu_id'],
+                          wordify_locales=wordify_locales, read_only=read_only)
+        tenants[slug] = Tenant(slug, sage, fetcher)
+
+    return tenants
@@ -0,0 +1,60 @@
+from datetime import date
+from menu.scrapers.sage import STATION_TITLES
+
+# The wording of a spoken menu in each language. Station titles and meal titles aren't
+# translated, as they're names
+WORDIFY_LOCALES = {
+    'en': {'intro': 'The menu for {date}', 'empty': 'There is no menu for {date}',
+           'date': '{weekday}, {month} {day:02}, {year}',
+           'weekdays': ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday',
+                        'Sunday'),
+           'months': ('January', 'February', 'March', 'April', 'May', 'June', 'July', 'August',
+                      'September', 'October', 'November', 'December')},
+    'es': {'intro': 'El menú del {date}', 'empty': 'No hay menú para el {date}',
+           'date': '{weekday} {day} de {month} de {year}',
+           'weekdays': ('lunes', 'martes', 'miércoles', 'jueves', 'viernes', 'sábado', 'domingo'),
+           'months': ('enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio', 'agosto',
+                      'septiembre', 'octubre', 'noviembre', 'diciembre')},
+    'fr': {'intro': 'Le menu du {date}', 'empty': "Il n'y a pas de menu pour le {date}",
+           'date': '{weekday} {day} {month} {year}',
+           'weekdays': ('lundi', 'mardi', 'mercredi', 'jeudi', 'vendredi', 'samedi', 'dimanche'),
+           'months': ('janvier', 'février', 'mars', 'avril', 'mai', 'juin', 'juillet', 'août',
+                      'septembre', 'octobre', 'novembre', 'décembre')},
+}
+
+
+def format_spoken_date(day: date, locale: str) -> str:
+    '''
+    Formats a date the way it's said in a locale, like Monday, October 19, 2026
+    '''
+    wording = WORDIFY_LOCALES[locale]
+    return wording['date'].format(weekday=wording['weekdays'][day.weekday()],
+                                  month=wording['months'][day.month - 1], day=day.day,
+                                  year=day.year)
+
+def build_wordify_text(day: date, menu_data: dict, meal_titles: list, locale: str) -> str:
+    '''
+    Makes one day of menu data human readable
+
+    day: the date of the menu
+    menu_data: the day's menu items, grouped by meal and station like in Fetcher.fetch_days,
+        or an empty dict if there's no menu that day
+    meal_titles: the titles of the meals
+    locale: one of WORDIFY_LOCALES
+
+    returns: str, A human readable representation of the menu
+    '''
+    wording = WORDIFY_LOCALES[locale]
+    spoken_date = format_spoken_date(day, locale)
+
+    if not menu_data:
+        return wording['empty'].format(date=spoken_date)
+
+    lines = [wording['intro'].format(date=spoken_date)]
+    for meal, meal_value in menu_data.items():
+        lines += ['', meal_titles[int(meal)]]
+        for station, station_value in meal_value.items():
+            lines += ['', STATION_TITLES[int(station)]]
+            lines += [menu_item['name'] for menu_item in station_value]
+
+    return '\n'.join(lines)
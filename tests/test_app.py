@@ -0,0 +1,139 @@
+'''
+End to end tests of the app, scraping from the benchmark stub of Sage instead of the real thing
+'''
+import html
+import json
+import sqlite3
+from datetime import date, timedelta
+import pytest
+from benchmarks.data import MenuGenerator
+from benchmarks.stub import SageStub
+from menu import app as menu_app
+from menu.migrations import MIGRATIONS
+from menu.scrapers import sage
+from menu.scrapers.sage import SageDateHandler
+
+# How many weeks the stub's menu has. It started a week ago, so the current week is week 1
+CYCLE_LENGTH = 4
+FIRST_DATE = (date.today() - timedelta(weeks=1)).strftime('%m/%d/%Y')
+
+# The menu item table as the first version of the app made it, before any migration
+BASELINE_SCHEMA = '''
+CREATE TABLE sage_menu_item (
+    id INTEGER NOT NULL, menu_id INTEGER NOT NULL, recipe_id INTEGER NOT NULL,
+    day INTEGER NOT NULL, week INTEGER NOT NULL, meal INTEGER NOT NULL, card INTEGER,
+    dot INTEGER, station INTEGER NOT NULL, name TEXT NOT NULL, allergens TEXT,
+    date DATE NOT NULL, misc TEXT, PRIMARY KEY (id)
+)
+'''
+
+
+@pytest.fixture(name='generator')
+def fixture_generator():
+    return MenuGenerator()
+
+
+@pytest.fixture(name='stub')
+def fixture_stub(generator, monkeypatch):
+    stub = SageStub(generator, CYCLE_LENGTH, FIRST_DATE)
+    base_url = stub.start()
+
+    class StubScraper(sage.SageScraper):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, base_url=base_url, **kwargs)
+
+    # Every scrape the app runs goes to the stub
+    monkeypatch.setattr(sage, 'SageScraper', StubScraper)
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture(name='config_path')
+def fixture_config_path(tmp_path, generator):
+    config = {'sage': {'email': 'test@example.com', 'password': 'password', 'unit_id': 1370,
+                       'menu_id': generator.menu_id, 'menu_titles': ['Breakfast', 'Lunch',
+                                                                     'Dinner']},
+              'db_path': str(tmp_path / 'menu.sqlite3'), 'timezone': 'America/Chicago',
+              'scrape_key': 'key'}
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps(config))
+    return str(config_path)
+
+
+def scrape(app):
+    '''
+    Starts a scrape through POST /scrape, and waits for it to finish
+    '''
+    response = app.test_client().post('/scrape', data={'scrape_key': 'key'})
+    assert response.status_code == 202
+
+    with app.app_context():
+        job = menu_app.get_state(app).scrape_queue.wait(response.json['job_id'])
+    assert job['status'] == 'finished'
+    return job
+
+
+def test_scrape_fetch_round_trip(stub, config_path, generator):
+    app = menu_app.create_app(config_path)
+    scrape(app)
+
+    # Every menu item of the current week comes back out of /fetch, with its name unescaped
+    date_handler = SageDateHandler(CYCLE_LENGTH, FIRST_DATE)
+    week = date_handler.get_current_week()
+    sunday = date_handler.sage_to_date(week, 0)
+    expected = {(int(item['id']), html.unescape(item['name'])) for item in generator.week(week)}
+
+    response = app.test_client().get('/fetch', query_string={'date': sunday.isoformat(),
+                                                             'days': 7})
+    assert response.status_code == 200
+
+    fetched = set()
+    for day in response.json.values():
+        for meal in day.values():
+            for station in meal.values():
+                fetched.update((item['id'], item['name']) for item in station)
+    assert fetched == expected
+
+
+def test_repeated_request_is_not_modified(stub, config_path):
+    app = menu_app.create_app(config_path)
+    scrape(app)
+    client = app.test_client()
+
+    for url in ('/', '/fetch', '/wordify'):
+        response = client.get(url)
+        assert response.status_code == 200
+
+        response = client.get(url, headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+        assert not response.data
+
+    # Once Sage has an update, scraping it changes the data version, so the ETag changes too
+    etag = client.get('/fetch').headers['ETag']
+    stub.last_update = str(int(stub.last_update) + 1)
+    scrape(app)
+    assert client.get('/fetch', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_baseline_db_upgrades_to_latest(tmp_path, config_path):
+    # A db from before any migration, with an escaped name like Sage sends
+    connection = sqlite3.connect(tmp_path / 'menu.sqlite3')
+    connection.execute(BASELINE_SCHEMA)
+    connection.execute(
+        'INSERT INTO sage_menu_item VALUES (9094500000000, 90945, 134068, 0, 0, 1, 0, 4, 0, '
+        '\'Chicken &amp; Rice\', \'[{"id": "612"}, {"id": "164"}]\', \'2019-08-18\', '
+        '\'{"desc": "", "featured": true}\')')
+    connection.commit()
+    connection.close()
+
+    app = menu_app.create_app(config_path)
+
+    connection = sqlite3.connect(tmp_path / 'menu.sqlite3')
+    assert connection.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+    connection.close()
+
+    # The menu item is still served, with its allergens in Sage's order
+    response = app.test_client().get('/fetch', query_string={'date': '2019-08-18'})
+    item, = response.json['2019-08-18']['1']['0']
+    assert item['name'] == 'Chicken & Rice'
+    assert json.loads(item['allergens']) == [{'id': '612'}, {'id': '164'}]